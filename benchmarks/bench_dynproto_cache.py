@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+"""
+	process startup with DynFDS: building every module from the
+	FileDescriptorSet vs loading them from the cache_dir _pb2 sources vs
+	building only the file of one message lazily
+
+	every case runs in a fresh interpreter, in this order:
+	  nocache    DynFDS without cache_dir
+	  cold       empty cache_dir, modules are built and written
+	  warm       cache_dir with the sources and .pyc files
+	  lazy       lazy DynFDS without cache_dir, then get_message(--message)
+
+	python benchmarks/bench_dynproto_cache.py --files 400 --messages 10 --fields 10
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+
+from schema import schema_set_fds
+from pb_tools.dynproto import DynFDS
+
+
+def child(fds_path, cache_dir, message):
+	with open(fds_path, 'rb') as f:
+		descriptor_bin = f.read()
+	t = time.time()
+	fds = DynFDS(descriptor_bin, cache_dir=cache_dir, lazy=message is not None)
+	if message is not None:
+		fds.get_message(message)
+	elapsed = time.time() - t
+	print(json.dumps({
+		'seconds': elapsed,
+		'modules': len(fds.fdp),
+		'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+	}))
+
+
+def run(fds_path, cache_dir, message):
+	cmd = [sys.executable, os.path.abspath(__file__), '--child', fds_path]
+	if cache_dir is not None:
+		cmd += ['--cache-dir', cache_dir]
+	if message is not None:
+		cmd += ['--message', message]
+	return json.loads(subprocess.check_output(cmd))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--files', type=int, default=400)
+	parser.add_argument('--messages', type=int, default=10)
+	parser.add_argument('--fields', type=int, default=10)
+	parser.add_argument('--message', default=None, help='message for the lazy case, set.f0.m0 by default')
+	parser.add_argument('--child', help=argparse.SUPPRESS)
+	parser.add_argument('--cache-dir', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		return child(args.child, args.cache_dir, args.message)
+
+	tmp = tempfile.mkdtemp()
+	try:
+		fds_path = os.path.join(tmp, 'set.desc')
+		with open(fds_path, 'wb') as f:
+			f.write(schema_set_fds(args.files, args.messages, args.fields).SerializeToString())
+		cache_dir = os.path.join(tmp, 'cache')
+
+		baseline = None
+		cases = (
+			('nocache', None, None),
+			('cold', cache_dir, None),
+			('warm', cache_dir, None),
+			('lazy', None, args.message or 'set.f0.m0'),
+		)
+		for case, cache, message in cases:
+			result = run(fds_path, cache, message)
+			if baseline is None:
+				baseline = result['seconds']
+			print(json.dumps({
+				'case': case,
+				'files': result['modules'],
+				'maxrss_mb': result['maxrss_mb'],
+				'seconds': round(result['seconds'], 3),
+				'speedup': round(baseline / result['seconds'], 2),
+			}))
+	finally:
+		shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+
+"""
+	message to JSON bytes and back with every available JSON backend, and
+	with the streaming writer (dump into a BytesIO) which skips the
+	intermediate dict, on wide, deep and repeated-heavy messages
+
+	python benchmarks/bench_json_bytes.py --repeat 200
+"""
+
+import io
+import time
+import json
+import argparse
+
+from schema import shapes_module, fill_shapes
+from pb_tools import protobuf_json
+
+
+def timeit(f, repeat):
+	f()
+	t = time.time()
+	for i in range(repeat):
+		f()
+	return (time.time() - t) / repeat
+
+
+def dump_bytes(pb):
+	fp = io.BytesIO()
+	protobuf_json.dump(pb, fp)
+	return fp.getvalue()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--repeat', type=int, default=200)
+	parser.add_argument('--width', type=int, default=200)
+	parser.add_argument('--depth', type=int, default=20)
+	parser.add_argument('--rows', type=int, default=1000)
+	args = parser.parse_args()
+
+	proto = shapes_module(args.width, args.depth)
+	messages = fill_shapes(proto, args.width, args.depth, args.rows)
+
+	for shape in sorted(messages):
+		pb = messages[shape]
+		expected = protobuf_json.pb2json(pb)
+		paths = [(backend, lambda pb, b=backend: protobuf_json.pb2json_bytes(pb, b))
+			for backend in protobuf_json.json_backends()]
+		paths.append(('stream', dump_bytes))
+
+		for name, encode in paths:
+			data = encode(pb)
+			assert json.loads(data) == expected, (shape, name)
+			result = {
+				'shape': shape,
+				'path': name,
+				'bytes': len(data),
+				'encode_us': round(timeit(lambda: encode(pb), args.repeat) * 1e6, 1),
+			}
+			if name != 'stream':
+				decode = lambda: protobuf_json.json_bytes2pb(type(pb)(), data, name)
+				assert decode() == pb, (shape, name)
+				result['decode_us'] = round(timeit(decode, args.repeat) * 1e6, 1)
+			print(json.dumps(result))
+
+
+if __name__ == '__main__':
+	main()
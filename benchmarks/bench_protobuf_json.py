@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+
+"""
+	pb2json and json2pb with converters compiled per descriptor vs the
+	former interpreter over DESCRIPTOR.fields, on wide, deep and
+	repeated-heavy messages
+
+	masked rows compare the full conversion with a field mask selecting a
+	thin view of the same message.
+
+	python benchmarks/bench_protobuf_json.py --repeat 200
+"""
+
+import time
+import json
+import argparse
+
+from schema import shapes_module, fill_shapes
+from pb_tools import protobuf_json
+from pb_tools.protobuf_json import ParseError, FD, _ftype2js, _js2ftype
+
+
+def legacy_enum_value_as_int(field, value):
+	d = field.enum_type.values_by_name
+	if type(value) is str:
+		if value in d:
+			return d[value].number
+		raise ParseError("Field %s unknown enum value '%s'" % (field.full_name, value))
+	return value
+
+
+def legacy_enum_value_as_str(field, value):
+	d = field.enum_type.values_by_number
+	if type(value) is int:
+		if value in d:
+			return d[value].name
+		raise ParseError("Field %s unknown enum value '%s'" % (field.full_name, value))
+	return value
+
+
+def legacy_json2pb(pb, js):
+	""" the interpreter as it was, with py3 names for unicode and long """
+	for field in pb.DESCRIPTOR.fields:
+		if field.name not in js:
+			continue
+		if field.type == FD.TYPE_MESSAGE:
+			pass
+		elif field.type == FD.TYPE_ENUM:
+			pass
+		elif field.type in _js2ftype:
+			ftype = _js2ftype[field.type]
+		else:
+			raise ParseError("Field %s.%s of type '%d' is not supported" % (pb.__class__.__name__, field.name, field.type, ))
+		value = js[field.name]
+		if field.label == FD.LABEL_REPEATED:
+			pb_value = getattr(pb, field.name, None)
+			for v in value:
+				if field.type == FD.TYPE_MESSAGE:
+					legacy_json2pb(pb_value.add(), v)
+				elif field.type == FD.TYPE_ENUM:
+					pb_value.append(legacy_enum_value_as_int(field, v))
+				else:
+					pb_value.append(ftype(v))
+		else:
+			if field.type == FD.TYPE_MESSAGE:
+				legacy_json2pb(getattr(pb, field.name, None), value)
+			elif field.type == FD.TYPE_ENUM:
+				setattr(pb, field.name, legacy_enum_value_as_int(field, value))
+			else:
+				setattr(pb, field.name, ftype(value))
+	return pb
+
+
+def legacy_pb2json(pb):
+	js = {}
+	fields = pb.ListFields()
+
+	def field_get_value(field, value):
+		if field.type == FD.TYPE_MESSAGE:
+			return legacy_pb2json(value)
+		elif field.type == FD.TYPE_ENUM:
+			return legacy_enum_value_as_str(field, value)
+		elif field.type in _ftype2js:
+			return _ftype2js[field.type](value)
+		else:
+			raise ParseError("Field %s.%s of type '%d' is not supported" % (pb.__class__.__name__, field.name, field.type))
+
+	for field, value in fields:
+		if field.label == FD.LABEL_REPEATED:
+			js_value = []
+			for v in value:
+				js_value.append(field_get_value(field, v))
+		else:
+			js_value = field_get_value(field, value)
+		js[field.name] = js_value
+	return js
+
+
+MASKS = {
+	'wide': ['f0', 'f1'],
+	'deep': ['id', 'child.child.name'],
+	'rows': ['ids', 'row.*.id'],
+}
+
+
+def timeit(f, repeat):
+	f()
+	t = time.time()
+	for i in range(repeat):
+		f()
+	return (time.time() - t) / repeat
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--repeat', type=int, default=200)
+	parser.add_argument('--width', type=int, default=200)
+	parser.add_argument('--depth', type=int, default=20)
+	parser.add_argument('--rows', type=int, default=1000)
+	args = parser.parse_args()
+
+	proto = shapes_module(args.width, args.depth)
+	for shape, msg in sorted(fill_shapes(proto, args.width, args.depth, args.rows).items()):
+		js = protobuf_json.pb2json(msg)
+		assert js == legacy_pb2json(msg)
+		assert protobuf_json.json2pb(msg.__class__(), js) == msg
+
+		results = {}
+		for name, pb2json, json2pb in (
+				('legacy', legacy_pb2json, legacy_json2pb),
+				('compiled', protobuf_json.pb2json, protobuf_json.json2pb)):
+			results[name] = (
+				timeit(lambda: pb2json(msg), args.repeat),
+				timeit(lambda: json2pb(msg.__class__(), js), args.repeat))
+
+		for i, direction in enumerate(('pb2json', 'json2pb')):
+			print(json.dumps({
+				'shape': shape,
+				'func': direction,
+				'legacy_us': round(results['legacy'][i] * 1e6, 1),
+				'compiled_us': round(results['compiled'][i] * 1e6, 1),
+				'speedup': round(results['legacy'][i] / results['compiled'][i], 2),
+			}))
+
+		mask = MASKS[shape]
+		for direction, full, masked in (
+				('pb2json', lambda: protobuf_json.pb2json(msg), lambda: protobuf_json.pb2json(msg, mask)),
+				('json2pb', lambda: protobuf_json.json2pb(msg.__class__(), js),
+					lambda: protobuf_json.json2pb(msg.__class__(), js, mask))):
+			full_time, masked_time = timeit(full, args.repeat), timeit(masked, args.repeat)
+			print(json.dumps({
+				'shape': shape,
+				'func': direction,
+				'mask': mask,
+				'full_us': round(full_time * 1e6, 1),
+				'masked_us': round(masked_time * 1e6, 1),
+				'speedup': round(full_time / masked_time, 2),
+			}))
+
+
+if __name__ == '__main__':
+	main()
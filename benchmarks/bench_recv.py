@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+
+"""
+	client receive path throughput for large responses: recv_into a reusable
+	buffer vs the former recv and concatenate path
+
+	a plain socket thread answers every request with a prebuilt frame, so
+	that only the client side is measured.
+
+	python benchmarks/bench_recv.py --sizes 1,4,16,64 --repeat 5
+"""
+
+import time
+import json
+import struct
+import socket
+import argparse
+import threading
+
+from schema import bench_module
+from pb_tools.pbservice import PBService, IOFailed
+
+
+class LegacyRecvPBService(PBService):
+
+	""" receive path as it was before recv_into """
+
+	def _recv_n(self, n):
+		buf = b''
+
+		while (len(buf) < n):
+			chunk = self._sock.recv(n - len(buf))
+			if chunk == b'':
+				break
+			buf += chunk
+
+		if len(buf) != n:
+			self._clean_close()
+			raise IOFailed("Truncated message: received %d bytes out of %d expected" % (len(buf), n))
+
+		return buf
+
+	def _recv_msg(self, classes):
+		buf = self._recv_n(4)
+		msg_len = struct.unpack('!I', buf)[0]
+
+		buf = self._recv_n(msg_len)
+		msgid = struct.unpack('!I', buf[0:4])[0]
+		body = buf[4:]
+
+		return self._codec.decode(classes, msgid, body)
+
+
+def frame_server(frame):
+	listener = socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(16)
+
+	def serve():
+		while True:
+			sock, address = listener.accept()
+			threading.Thread(target=answer, args=(sock,), daemon=True).start()
+
+	def answer(sock):
+		while True:
+			header = sock.recv(8, socket.MSG_WAITALL)
+			if len(header) < 8:
+				break
+			msg_len = struct.unpack('!I', header[:4])[0]
+			sock.recv(msg_len - 4, socket.MSG_WAITALL)
+			sock.sendall(frame)
+		sock.close()
+
+	threading.Thread(target=serve, daemon=True).start()
+	return listener.getsockname()[1]
+
+
+def bench(cls, proto, port, size, repeat):
+	svc = cls(host='127.0.0.1', port=port, module=proto, recv_buffer_limit=128 * 1024 * 1024)
+	req = proto.request_echo(n=1)
+	svc._pb2_call(req)  # connect and warm up buffers
+	t = time.time()
+	for i in range(repeat):
+		svc._pb2_call(req)
+	elapsed = time.time() - t
+	svc.close()
+	return elapsed
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', default='1,4,16,64', help='response sizes, MB')
+	parser.add_argument('--repeat', type=int, default=5)
+	args = parser.parse_args()
+
+	proto = bench_module()
+	for size in [int(s) for s in args.sizes.split(',')]:
+		msg = proto.response_echo(payload='x' * (size * 1024 * 1024))
+		frame = PBService(host='127.0.0.1', port=0, module=proto)._encode_msg(msg)
+		port = frame_server(frame)
+		for name, cls in (('legacy', LegacyRecvPBService), ('recv_into', PBService)):
+			elapsed = bench(cls, proto, port, size, args.repeat)
+			print(json.dumps({
+				'path': name,
+				'size_mb': size,
+				'calls_per_sec': round(args.repeat / elapsed, 2),
+				'mb_per_sec': round(size * args.repeat / elapsed, 1),
+			}))
+
+
+if __name__ == '__main__':
+	main()
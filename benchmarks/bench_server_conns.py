@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+
+"""
+	connection count scaling of the asyncore PBServer vs AsyncPBServer
+
+	every client connection runs sequential echo calls for --duration seconds,
+	client connections are spread over --client-procs processes so that the
+	load generator is not the bottleneck. the server runs in its own process.
+
+	python benchmarks/bench_server_conns.py --conns 10,100,1000,4000
+"""
+
+import sys
+import time
+import json
+import socket
+import asyncio
+import argparse
+import resource
+import multiprocessing
+
+from schema import bench_module
+from pb_tools.pbservice import PBServer, IOFailed
+from pb_tools.aiopbservice import AsyncPBServer, AsyncPBService
+
+
+class EchoServer(PBServer):
+
+	def request_echo(self, request):
+		return self.proto.response_echo(payload=request.payload, n=request.n)
+
+
+class AsyncEchoServer(AsyncPBServer):
+
+	def request_echo(self, request):
+		return self.proto.response_echo(payload=request.payload, n=request.n)
+
+
+ENGINES = {
+	'asyncore': EchoServer,
+	'asyncio': AsyncEchoServer,
+}
+
+
+def raise_nofile_limit():
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def run_server(engine, port):
+	raise_nofile_limit()
+	ENGINES[engine](host='127.0.0.1', port=port, module=bench_module()).serve()
+
+
+def run_clients(port, conns, duration, payload_size, results):
+	raise_nofile_limit()
+	proto = bench_module()
+
+	async def client(deadline, latencies, errors):
+		svc = AsyncPBService(host='127.0.0.1', port=port, module=proto, io_timeout=30)
+		req = proto.request_echo(payload='x' * payload_size)
+		try:
+			while time.time() < deadline:
+				t = time.time()
+				await svc._pb2_call(req)
+				latencies.append(time.time() - t)
+		except IOFailed:
+			errors.append(1)
+		await svc.close()
+
+	async def main():
+		latencies, errors = [], []
+		deadline = time.time() + duration
+		await asyncio.gather(*[client(deadline, latencies, errors) for i in range(conns)])
+		return latencies, errors
+
+	latencies, errors = asyncio.run(main())
+	results.put((latencies, len(errors)))
+
+
+def bench(engine, conns, duration, client_procs, payload_size):
+	port = free_port()
+	server = multiprocessing.Process(target=run_server, args=(engine, port))
+	server.start()
+	time.sleep(1)
+
+	results = multiprocessing.Queue()
+	per_proc = [conns // client_procs + (i < conns % client_procs) for i in range(client_procs)]
+	clients = [multiprocessing.Process(target=run_clients, args=(port, n, duration, payload_size, results))
+		for n in per_proc if n > 0]
+	for p in clients:
+		p.start()
+	latencies, errors = [], 0
+	for p in clients:
+		l, e = results.get()
+		latencies.extend(l)
+		errors += e
+	for p in clients:
+		p.join()
+
+	server_alive = server.is_alive()
+	server.terminate()
+	server.join()
+
+	latencies.sort()
+	def pct(q):
+		if not len(latencies):
+			return None
+		return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+
+	return {
+		'engine': engine,
+		'conns': conns,
+		'calls_per_sec': round(len(latencies) / duration, 1),
+		'p50_ms': pct(0.5),
+		'p99_ms': pct(0.99),
+		'failed_conns': errors,
+		'server_alive': server_alive,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--engines', default='asyncore,asyncio')
+	parser.add_argument('--conns', default='10,100,1000,4000')
+	parser.add_argument('--duration', type=float, default=5)
+	parser.add_argument('--client-procs', type=int, default=max(1, multiprocessing.cpu_count() - 1))
+	parser.add_argument('--payload-size', type=int, default=64)
+	args = parser.parse_args()
+
+	for conns in [int(c) for c in args.conns.split(',')]:
+		for engine in args.engines.split(','):
+			print(json.dumps(bench(engine, conns, args.duration, args.client_procs, args.payload_size)))
+			sys.stdout.flush()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+
+"""
+	the hot paths of pb_tools in one run, one JSON line per result, so that
+	runs on two versions can be compared:
+
+	  rpc        PBService to PBServer round trips over loopback TCP and a
+	             unix socket, sequential and from --clients threads with a
+	             connection each, on small, medium and large payloads.
+	             the server runs in its own process.
+	  json       pb2json and json2pb on wide, deep and repeated-heavy messages
+	  dynproto   DynFDS load time of a set of --files synthetic files,
+	             in a fresh interpreter
+
+	the first line describes the environment. --output also writes all the
+	lines as one JSON document.
+
+	python benchmarks/bench_suite.py --suites rpc,json,dynproto --output before.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import multiprocessing
+
+from schema import bench_module, shapes_module, fill_shapes, schema_set_fds
+from pb_tools import protobuf_json
+from pb_tools.pbservice import PBService, PBServer
+import bench_dynproto_cache
+
+
+PAYLOADS = {
+	'small': 64,
+	'medium': 16 * 1024,
+	'large': 1024 * 1024,
+}
+
+
+class EchoServer(PBServer):
+
+	def request_echo(self, request):
+		return self.proto.response_echo(payload=request.payload, n=request.n)
+
+
+def environment():
+	from google.protobuf import __version__ as protobuf_version
+	from google.protobuf.internal import api_implementation
+	return {
+		'suite': 'environment',
+		'python': platform.python_version(),
+		'protobuf': protobuf_version,
+		'protobuf_implementation': api_implementation.Type(),
+		'json_backends': protobuf_json.json_backends(),
+		'machine': platform.machine(),
+		'cpus': multiprocessing.cpu_count(),
+	}
+
+
+def run_server(address, ready):
+	if isinstance(address, str):
+		server = EchoServer(unix_socket=address, module=bench_module())
+	else:
+		server = EchoServer(host=address[0], port=address[1], module=bench_module())
+	ready.set()
+	server.serve()
+
+
+def free_port():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def percentile(latencies, q):
+	return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6, 1)
+
+
+def rpc_clients(connect, proto, payload, clients, duration):
+	""" latencies of calls made by clients threads in duration seconds """
+	req = proto.request_echo(payload='x' * payload, n=1)
+	latencies = []
+	start = threading.Barrier(clients + 1)
+
+	def client():
+		svc = connect()
+		svc._pb2_call(req)  # connect and warm up buffers
+		mine = []
+		start.wait()
+		deadline = time.perf_counter() + duration
+		while True:
+			t = time.perf_counter()
+			if t >= deadline:
+				break
+			svc._pb2_call(req)
+			mine.append(time.perf_counter() - t)
+		svc.close()
+		latencies.extend(mine)
+
+	threads = [threading.Thread(target=client) for i in range(clients)]
+	for t in threads:
+		t.start()
+	start.wait()
+	for t in threads:
+		t.join()
+	latencies.sort()
+	return latencies
+
+
+def bench_rpc(args):
+	tmp = tempfile.mkdtemp()
+	try:
+		transports = (
+			('tcp', ('127.0.0.1', free_port())),
+			('unix', os.path.join(tmp, 'bench.sock')),
+		)
+		proto = bench_module()
+		for transport, address in transports:
+			ready = multiprocessing.Event()
+			server = multiprocessing.Process(target=run_server, args=(address, ready), daemon=True)
+			server.start()
+			ready.wait()
+			time.sleep(0.2)
+			if transport == 'unix':
+				connect = lambda: PBService(unix_socket=address, module=proto)
+			else:
+				connect = lambda: PBService(host=address[0], port=address[1], module=proto)
+			try:
+				for payload in args.payloads.split(','):
+					for mode, clients in (('sequential', 1), ('concurrent', args.clients)):
+						latencies = rpc_clients(connect, proto, PAYLOADS[payload], clients, args.duration)
+						yield {
+							'suite': 'rpc',
+							'transport': transport,
+							'payload': payload,
+							'payload_bytes': PAYLOADS[payload],
+							'mode': mode,
+							'clients': clients,
+							'calls_per_sec': round(len(latencies) / args.duration, 1),
+							'mb_per_sec': round(2 * PAYLOADS[payload] * len(latencies) / args.duration / 1e6, 2),
+							'p50_us': percentile(latencies, 0.5),
+							'p99_us': percentile(latencies, 0.99),
+						}
+			finally:
+				server.terminate()
+				server.join()
+	finally:
+		shutil.rmtree(tmp)
+
+
+def timeit(f, repeat):
+	f()
+	t = time.perf_counter()
+	for i in range(repeat):
+		f()
+	return (time.perf_counter() - t) / repeat
+
+
+def bench_json(args):
+	proto = shapes_module()
+	messages = fill_shapes(proto)
+	for shape in sorted(messages):
+		pb = messages[shape]
+		js = protobuf_json.pb2json(pb)
+		yield {
+			'suite': 'json',
+			'shape': shape,
+			'pb2json_us': round(timeit(lambda: protobuf_json.pb2json(pb), args.repeat) * 1e6, 1),
+			'json2pb_us': round(timeit(lambda: protobuf_json.json2pb(type(pb)(), js), args.repeat) * 1e6, 1),
+		}
+
+
+def bench_dynproto(args):
+	tmp = tempfile.mkdtemp()
+	try:
+		fds_path = os.path.join(tmp, 'set.desc')
+		with open(fds_path, 'wb') as f:
+			f.write(schema_set_fds(args.files).SerializeToString())
+		result = bench_dynproto_cache.run(fds_path, None, None)
+		yield {
+			'suite': 'dynproto',
+			'files': result['modules'],
+			'load_seconds': round(result['seconds'], 3),
+			'maxrss_mb': result['maxrss_mb'],
+		}
+	finally:
+		shutil.rmtree(tmp)
+
+
+SUITES = {
+	'rpc': bench_rpc,
+	'json': bench_json,
+	'dynproto': bench_dynproto,
+}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--suites', default='rpc,json,dynproto')
+	parser.add_argument('--payloads', default='small,medium,large')
+	parser.add_argument('--clients', type=int, default=8)
+	parser.add_argument('--duration', type=float, default=2, help='seconds per rpc case')
+	parser.add_argument('--repeat', type=int, default=200, help='calls per json case')
+	parser.add_argument('--files', type=int, default=400)
+	parser.add_argument('--output', help='file for all the results as one JSON document')
+	args = parser.parse_args()
+
+	results = [environment()]
+	print(json.dumps(results[0]))
+	for suite in args.suites.split(','):
+		for result in SUITES[suite](args):
+			results.append(result)
+			print(json.dumps(result))
+			sys.stdout.flush()
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,194 @@
+#! /usr/bin/env python
+
+"""
+	synthetic bench.proto compiled with pb_tools.dynproto, so that benchmarks
+	need neither protoc nor generated _pb2 files
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from google.protobuf import descriptor_pb2
+from pb_tools.dynproto import DynFDP
+
+F = descriptor_pb2.FieldDescriptorProto
+
+
+def add_enum(fdp, name, values):
+	enum = fdp.enum_type.add()
+	enum.name = name
+	for number, value_name in enumerate(values, 1):
+		value = enum.value.add()
+		value.name = value_name
+		value.number = number
+
+
+def add_message(fdp, name, fields):
+	msg = fdp.message_type.add()
+	msg.name = name
+	for number, (field_name, field_type) in enumerate(fields, 1):
+		field = msg.field.add()
+		field.name = field_name
+		field.number = number
+		field.type = field_type
+		field.label = F.LABEL_OPTIONAL
+	return msg
+
+
+def bench_fdp():
+	fdp = descriptor_pb2.FileDescriptorProto()
+	fdp.name = 'bench.proto'
+	fdp.package = 'bench'
+	add_enum(fdp, 'request_msgid', ['REQUEST_ECHO'])
+	add_enum(fdp, 'response_msgid', ['RESPONSE_GENERIC', 'RESPONSE_ECHO'])
+	add_message(fdp, 'request_echo', [('payload', F.TYPE_STRING), ('n', F.TYPE_INT32)])
+	add_message(fdp, 'response_echo', [('payload', F.TYPE_STRING), ('n', F.TYPE_INT32)])
+	add_message(fdp, 'response_generic', [('error_code', F.TYPE_INT32), ('error_text', F.TYPE_STRING)])
+	return fdp
+
+
+def bench_module():
+	return DynFDP(None, bench_fdp()).module
+
+
+def add_field(msg, name, field_type, label=F.LABEL_OPTIONAL, type_name=None):
+	field = msg.field.add()
+	field.name = name
+	field.number = len(msg.field)
+	field.type = field_type
+	field.label = label
+	if type_name is not None:
+		field.type_name = type_name
+	return field
+
+
+SCALAR_TYPES = [F.TYPE_INT32, F.TYPE_INT64, F.TYPE_UINT32, F.TYPE_DOUBLE, F.TYPE_BOOL, F.TYPE_STRING]
+
+
+def shapes_fdp(width=200, depth=20):
+	"""
+		wide: width scalar fields of mixed types
+		deep: a chain of depth nested messages
+		rows: repeated scalars, enums and small messages
+	"""
+	fdp = descriptor_pb2.FileDescriptorProto()
+	fdp.name = 'shapes.proto'
+	fdp.package = 'shapes'
+
+	enum = fdp.enum_type.add()
+	enum.name = 'color'
+	for number, name in enumerate(['RED', 'GREEN', 'BLUE']):
+		value = enum.value.add()
+		value.name = name
+		value.number = number
+
+	wide = fdp.message_type.add()
+	wide.name = 'wide'
+	for i in range(width):
+		add_field(wide, 'f%d' % i, SCALAR_TYPES[i % len(SCALAR_TYPES)])
+
+	for level in range(depth):
+		deep = fdp.message_type.add()
+		deep.name = 'deep%d' % level
+		add_field(deep, 'id', F.TYPE_INT32)
+		add_field(deep, 'name', F.TYPE_STRING)
+		add_field(deep, 'color', F.TYPE_ENUM, type_name='.shapes.color')
+		if level + 1 < depth:
+			add_field(deep, 'child', F.TYPE_MESSAGE, type_name='.shapes.deep%d' % (level + 1))
+
+	row = fdp.message_type.add()
+	row.name = 'row'
+	add_field(row, 'id', F.TYPE_INT64)
+	add_field(row, 'score', F.TYPE_DOUBLE)
+	add_field(row, 'label', F.TYPE_STRING)
+
+	rows = fdp.message_type.add()
+	rows.name = 'rows'
+	add_field(rows, 'ids', F.TYPE_INT64, F.LABEL_REPEATED)
+	add_field(rows, 'scores', F.TYPE_DOUBLE, F.LABEL_REPEATED)
+	add_field(rows, 'colors', F.TYPE_ENUM, F.LABEL_REPEATED, '.shapes.color')
+	add_field(rows, 'row', F.TYPE_MESSAGE, F.LABEL_REPEATED, '.shapes.row')
+	return fdp
+
+
+def shapes_module(width=200, depth=20):
+	return DynFDP(None, shapes_fdp(width, depth)).module
+
+
+def fill_shapes(proto, width=200, depth=20, rows=1000):
+	""" one filled message of every shape, by shape name """
+	wide = proto.wide()
+	for i, field in enumerate(wide.DESCRIPTOR.fields):
+		value = {
+			F.TYPE_INT32: i, F.TYPE_INT64: i << 40, F.TYPE_UINT32: i, F.TYPE_DOUBLE: i / 3.0,
+			F.TYPE_BOOL: True, F.TYPE_STRING: 'value %d' % i,
+		}[field.type]
+		setattr(wide, field.name, value)
+
+	deep = proto.deep0()
+	msg = deep
+	for level in range(depth):
+		msg.id = level
+		msg.name = 'level %d' % level
+		msg.color = level % 3
+		if level + 1 < depth:
+			msg = msg.child
+
+	many = proto.rows()
+	many.ids.extend(range(rows))
+	many.scores.extend([i / 7.0 for i in range(rows)])
+	many.colors.extend([i % 3 for i in range(rows)])
+	for i in range(rows):
+		many.row.add(id=i, score=i * 0.5, label='row %d' % i)
+
+	return {'wide': wide, 'deep': deep, 'rows': many}
+
+
+def schema_set_fds(files=400, messages=10, fields=10):
+	"""
+		FileDescriptorSet of files set/fN.proto, every file has an enum,
+		messages with a nested message and enum, fields with defaults, and
+		depends on the previous file using one of its messages
+	"""
+	fds = descriptor_pb2.FileDescriptorSet()
+	for n in range(files):
+		fdp = fds.file.add()
+		fdp.name = 'set/f%d.proto' % n
+		fdp.package = 'set.f%d' % n
+		if n:
+			fdp.dependency.append('set/f%d.proto' % (n - 1))
+
+		enum = fdp.enum_type.add()
+		enum.name = 'kind'
+		for number, name in enumerate(['K%d_A' % n, 'K%d_B' % n, 'K%d_C' % n]):
+			value = enum.value.add()
+			value.name = name
+			value.number = number
+
+		for m in range(messages):
+			msg = fdp.message_type.add()
+			msg.name = 'm%d' % m
+			nested = msg.nested_type.add()
+			nested.name = 'item'
+			add_field(nested, 'id', F.TYPE_INT64)
+			add_field(nested, 'name', F.TYPE_STRING).default_value = 'none'
+			nested_enum = msg.enum_type.add()
+			nested_enum.name = 'state'
+			for number, name in enumerate(['ON', 'OFF']):
+				value = nested_enum.value.add()
+				value.name = name
+				value.number = number
+			for i in range(fields):
+				field = add_field(msg, 'f%d' % i, SCALAR_TYPES[i % len(SCALAR_TYPES)])
+				if i % 3 == 0:
+					field.default_value = {
+						F.TYPE_INT32: '7', F.TYPE_INT64: '-7', F.TYPE_UINT32: '7', F.TYPE_DOUBLE: '0.5',
+						F.TYPE_BOOL: 'true', F.TYPE_STRING: 'x'}[field.type]
+			add_field(msg, 'kind', F.TYPE_ENUM, type_name='.set.f%d.kind' % n)
+			add_field(msg, 'state', F.TYPE_ENUM, type_name='.set.f%d.m%d.state' % (n, m))
+			add_field(msg, 'items', F.TYPE_MESSAGE, F.LABEL_REPEATED, type_name='.set.f%d.m%d.item' % (n, m))
+			if n:
+				add_field(msg, 'prev', F.TYPE_MESSAGE, type_name='.set.f%d.m%d' % (n - 1, m))
+	return fds
@@ -0,0 +1,385 @@
+#! /usr/bin/env python
+
+import socket
+import struct
+import asyncio
+import collections
+from pb_tools.pbservice import common, IOFailed, PBServer, SingleFlight
+
+
+class AsyncSingleFlight(SingleFlight):
+
+	""" SingleFlight of coroutines of one event loop """
+
+	async def call(self, call, req):
+		key, flight, leader = self._join(req, lambda: asyncio.get_running_loop().create_future())
+		if flight is None:
+			return await call(req)
+		if not leader:
+			await asyncio.shield(flight[0])
+			return self._result(flight)
+		o = e = None
+		try:
+			o = await call(req)
+			return o
+		except Exception as exc:
+			e = exc
+			raise
+		finally:
+			self._land(key, flight, o, e)
+			flight[0].set_result(None)
+
+
+class AsyncPBService(common):
+
+	"""
+		asyncio flavour of PBService, same arguments and call surface:
+
+		svc = AsyncPBService(host='127.0.0.1', port=11013, proto='meetmaker')
+		user = await svc.user_get(user_id=123)
+
+		any number of coroutines may call concurrently over one connection,
+		requests are pipelined and responses are matched in request order.
+		every call must complete within io_timeout seconds.
+	"""
+
+	def __init__(self, **kvargs):
+		common.__init__(self, kvargs)
+		self._connect_timeout = 30
+
+		if 'connect_timeout' in kvargs:
+			self._connect_timeout = kvargs['connect_timeout']
+
+		self._reader = None
+		self._writer = None
+		self._connecting = None
+		self._read_task = None
+		self._pending = collections.deque()  # futures awaiting responses, in request order
+		self._service_error = None
+		if self._instrumented:
+			self._pb2_call = self._instrumented_pb2_call
+		self._init_single_flight(kvargs.get('single_flight'), AsyncSingleFlight)
+
+	async def _open_connection(self):
+		try:
+			if self._sock is not None:
+				conn = asyncio.open_connection(sock=self._sock)
+			elif self._family == socket.AF_UNIX:
+				conn = asyncio.open_unix_connection(self._addr)
+			else:
+				conn = asyncio.open_connection(*self._addr)
+			self._reader, self._writer = await asyncio.wait_for(conn, self._connect_timeout)
+		except (OSError, asyncio.TimeoutError) as e:
+			raise IOFailed("can't connect: %r" % e)
+		finally:
+			self._connecting = None
+		self._read_task = asyncio.ensure_future(self._read_responses(self._reader))
+
+	async def _connect(self):
+		if self._writer is not None:
+			return
+		if self._connecting is None:
+			self._connecting = asyncio.ensure_future(self._open_connection())
+		# all callers wait for the same connect, a cancelled one does not abort it
+		await asyncio.shield(self._connecting)
+
+	async def _read_responses(self, reader):
+		try:
+			while True:
+				msg_len, msgid = struct.unpack('!II', await reader.readexactly(8))
+				if msg_len < 4:
+					raise IOFailed("Bad message length %d" % msg_len)
+				body = await reader.readexactly(msg_len - 4)
+				if not len(self._pending):
+					raise IOFailed("Unexpected response msgid %d" % msgid)
+				fut = self._pending.popleft()
+				if fut.done():  # caller timed out or was cancelled
+					continue
+				try:
+					fut.set_result(self._codec.decode(self._codec.responses, msgid, body))
+				except Exception as e:
+					fut.set_exception(e)
+		except asyncio.CancelledError:
+			error = IOFailed("Connection closed")
+		except asyncio.IncompleteReadError as e:
+			error = IOFailed("Truncated message: received %d bytes out of %d expected" % (len(e.partial), e.expected))
+		except OSError as e:
+			error = IOFailed("Recv failed: %r" % e)
+		except IOFailed as e:
+			error = e
+		self._fail(reader, error)
+
+	def _fail(self, reader, error):
+		if reader is not self._reader:
+			return
+		self._writer.close()
+		if self._own_socket:
+			self._sock = None
+		self._reader = self._writer = self._read_task = None
+		pending, self._pending = self._pending, collections.deque()
+		for fut in pending:
+			if not fut.done():
+				fut.set_exception(error)
+
+	async def _roundtrip(self, req):
+		if self._writer is None:
+			raise IOFailed("Connection lost")
+		fut = asyncio.get_running_loop().create_future()
+		self._pending.append(fut)
+		self._writer.write(self._encode_msg(req))
+		try:
+			await self._writer.drain()
+		except OSError:
+			self._fail(self._reader, IOFailed("Send failed"))
+		return await fut
+
+	async def _pb2_call(self, req):
+		# retry once on connect, recv or send failure, but not on timeout
+		for retry in (True, False):
+			try:
+				await self._connect()
+				return await asyncio.wait_for(self._roundtrip(req), self._io_timeout)
+			except asyncio.TimeoutError:
+				raise IOFailed("No response in %s seconds" % self._io_timeout)
+			except IOFailed:
+				if not retry:
+					raise
+
+	async def _instrumented_pb2_call(self, req):
+		# _pb2_call with hooks and metrics. responses are decoded by the
+		# reader, receive covers encode, send and decode too
+		name = req.DESCRIPTOR.name
+		for retry in (True, False):
+			phases = []
+			call_started = self._before('call', name)
+			try:
+				if self._writer is None:
+					phase, started = 'connect', self._before('connect', name)
+					await self._connect()
+					phases.append(('connect', self._after(phase, name, started, None)))
+				phase, started = 'receive', self._before('receive', name)
+				o = await asyncio.wait_for(self._roundtrip(req), self._io_timeout)
+			except (IOFailed, asyncio.TimeoutError) as e:
+				timeout = isinstance(e, asyncio.TimeoutError)
+				if timeout:
+					e = IOFailed("No response in %s seconds" % self._io_timeout)
+				self._failed(phase, name, started, e)
+				self._failed('call', name, call_started, e)
+				self._record(name, failures=1)
+				if timeout or not retry:
+					raise e
+				continue
+			except Exception as e:
+				# a response which failed to decode
+				self._failed(phase, name, started, e)
+				self._failed('call', name, call_started, e)
+				self._record(name, failures=1)
+				raise
+			bytes_in, bytes_out = 8 + o.ByteSize(), 8 + req.ByteSize()
+			phases.append(('wait', self._after(phase, name, started, bytes_in)))
+			phases.append(('total', self._after('call', name, call_started, bytes_in + bytes_out)))
+			self._record(name, phases, calls=1, bytes_in=bytes_in, bytes_out=bytes_out, error_code=self._error_code(o))
+			return o
+
+	async def call_many(self, reqs):
+		responses = await asyncio.gather(*[self._pb2_call(req) for req in reqs])
+		self._service_error = None
+		for o in responses:
+			if self._is_service_error(o):
+				self._service_error = o
+				break
+		return responses
+
+	async def close(self):
+		if self._read_task is not None:
+			self._read_task.cancel()
+			writer = self._writer
+			await asyncio.gather(self._read_task, return_exceptions=True)
+			await writer.wait_closed()
+
+	def __getattr__(self, name):
+		async def call(self, *a, **kv):
+			o = await self._pb2_call(self._request_maker(name)(a, kv))
+			if self._is_service_error(o):
+				self._service_error = o
+			else:
+				self._service_error = None
+			return o
+		return self._cache_stub(self, name, call)
+
+
+class AsyncPBServer(PBServer):
+
+	"""
+		asyncio engine for PBServer handlers, takes the same arguments:
+
+		class LaccessServer(AsyncPBServer):
+
+			def request_get(self, request):
+				return self.ok()
+
+			async def request_update(self, request):
+				await something()
+				return self.error_user_not_exist("user not exist")
+
+		handlers return a pb2 response and may be coroutines, blocking ones
+		may go to a thread pool just like with PBServer. requests pipelined on
+		one connection are dispatched as they arrive, at most max_pipeline of
+		them in flight, and answered in request order.
+	"""
+
+	def __init__(self, **kvargs):
+		common.__init__(self, kvargs)
+		self._init_offload(kvargs)
+		self._handlers = {}
+		self._memos = {}
+		self._init_metrics_request(kvargs)
+		if self._instrumented:
+			self._dispatch = self._instrumented_dispatch
+		self._max_frame = 64 * 1024 * 1024  # larger requests close the connection
+		if 'max_frame' in kvargs:
+			self._max_frame = kvargs['max_frame']
+		self._server = None
+		self._reuse_port = False
+		self.client_conns = []
+
+	async def start(self):
+		if self._sock is not None:
+			self._server = await asyncio.start_server(self._handle_client, sock=self._sock)
+		elif self._family == socket.AF_UNIX:
+			self._server = await asyncio.start_unix_server(self._handle_client, path=self._addr, backlog=65535)
+		else:
+			self._server = await asyncio.start_server(self._handle_client, self._addr[0], self._addr[1],
+				backlog=65535, reuse_address=True, reuse_port=self._reuse_port)
+		return self._server
+
+	async def _serve(self):
+		if self._server is None:
+			await self.start()
+		async with self._server:
+			await self._server.serve_forever()
+
+	def _run(self):
+		asyncio.run(self._serve())
+
+	def _listen_in_master(self, reuse_port):
+		if self._sock is not None:
+			return False
+		if reuse_port and self._addr[1] != 0:
+			return True
+		# workers share one listening socket bound here
+		sock = socket.socket(self._family, socket.SOCK_STREAM)
+		if self._family == socket.AF_INET:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind(self._addr)
+		sock.listen(65535)
+		self._sock = sock
+		return False
+
+	def _listen_in_worker(self, reuse_port):
+		self._reuse_port = reuse_port
+
+	def _dispatch(self, msgid, body):
+		req_class, handler = self._handler(msgid)
+		req = req_class()
+		req.ParseFromString(body)
+		if self._offloaded(handler):
+			frame, handler = self._cached_offload(handler, req)
+			if frame is not None:
+				return frame
+			return asyncio.wrap_future(self._offload(handler, req))
+		res = handler(req)
+		if asyncio.iscoroutine(res):
+			return asyncio.ensure_future(res)
+		return self._encode_response(res)
+
+	def _instrumented_dispatch(self, msgid, body):
+		req_class, handler, req, name = self._instrumented_decode(msgid, body)
+		if self._offloaded(handler):
+			frame, handler = self._cached_offload(handler, req)
+			if frame is not None:
+				return self._instrumented_response(name, frame, self._before('dispatch', name))
+			return asyncio.wrap_future(self._offload(self._instrumented_offload(name, handler), req))
+		started = self._before('dispatch', name)
+		try:
+			res = handler(req)
+		except Exception as e:
+			self._instrumented_failure(name, started, e)
+			raise
+		if asyncio.iscoroutine(res):
+			return asyncio.ensure_future(self._instrumented_coroutine(name, res, started))
+		return self._instrumented_response(name, res, started)
+
+	async def _instrumented_coroutine(self, name, coro, started):
+		try:
+			res = await coro
+		except Exception as e:
+			self._instrumented_failure(name, started, e)
+			raise
+		return self._instrumented_response(name, res, started)
+
+	def _memo_result(self, memo, key, ttl, o):
+		if asyncio.iscoroutine(o):
+			return self._memo_awaited(memo, key, ttl, o)
+		return PBServer._memo_result(self, memo, key, ttl, o)
+
+	async def _memo_awaited(self, memo, key, ttl, coro):
+		return PBServer._memo_result(self, memo, key, ttl, await coro)
+
+	async def _handle_client(self, reader, writer):
+		responses = asyncio.Queue(self._max_pipeline)
+		writer_task = asyncio.ensure_future(self._write_responses(responses, writer))
+		self.client_conns.append(writer)
+		try:
+			while True:
+				msg_len, msgid = struct.unpack('!II', await reader.readexactly(8))
+				if msg_len < 4 or msg_len > self._max_frame:
+					break
+				body = await reader.readexactly(msg_len - 4)
+				try:
+					res = self._dispatch(msgid, body)
+				except Exception as e:
+					# the writer sends the responses queued before, then reports
+					# the failure and closes the connection
+					res = asyncio.get_running_loop().create_future()
+					res.set_exception(e)
+					await responses.put(res)
+					break
+				await responses.put(res)
+		except (asyncio.IncompleteReadError, OSError):
+			pass
+		except asyncio.CancelledError:
+			writer_task.cancel()
+			writer.close()
+			raise
+		finally:
+			self.client_conns.remove(writer)
+		await responses.put(None)
+		await writer_task
+
+	async def _write_responses(self, responses, writer):
+		closed = False
+		while True:
+			res = await responses.get()
+			if res is None:
+				break
+			if closed:
+				if isinstance(res, asyncio.Future):
+					res.cancel()
+				continue
+			try:
+				if isinstance(res, asyncio.Future):
+					res = await res
+					res = self._encode_response(res)
+				writer.write(res)
+				if responses.empty():
+					await writer.drain()
+			except Exception as e:
+				# the reader notices the closed transport and stops, the rest
+				# of the queue is dropped until it does
+				closed = True
+				writer.close()
+				if not isinstance(e, OSError):
+					asyncio.get_running_loop().call_exception_handler({
+						'message': 'handler failed', 'exception': e, 'transport': writer.transport})
+		writer.close()
@@ -1,4 +1,11 @@
 
+import os
+import hashlib
+import tempfile
+import threading
+import py_compile
+import importlib.util
+import google.protobuf
 from google.protobuf import descriptor
 from google.protobuf import message
 from google.protobuf import reflection
@@ -35,6 +42,79 @@ def GetCppType(t):
 		dfd.TYPE_SINT64:    dfd.CPPTYPE_INT64,
 	}[t]
 
+def ReadVarint(buf, pos):
+	result = shift = 0
+	while True:
+		b = buf[pos]
+		pos += 1
+		result |= (b & 0x7f) << shift
+		if b < 0x80:
+			return result, pos
+		shift += 7
+
+def LengthDelimitedFields(buf, pos=0, end=None):
+	# (number, start, end) of top level length delimited fields of a serialized message
+	if end is None:
+		end = len(buf)
+	while pos < end:
+		key, pos = ReadVarint(buf, pos)
+		wire_type = key & 7
+		if wire_type == 0:
+			pos = ReadVarint(buf, pos)[1]
+		elif wire_type == 1:
+			pos += 8
+		elif wire_type == 5:
+			pos += 4
+		elif wire_type == 2:
+			n, pos = ReadVarint(buf, pos)
+			yield key >> 3, pos, pos + n
+			pos += n
+		else:
+			raise Exception("unsupported wire type %d" % wire_type)
+
+def FileNameAndDeps(descriptor_bin):
+	# name and dependency of a serialized FileDescriptorProto, without parsing all of it
+	name, deps = None, []
+	for number, start, end in LengthDelimitedFields(descriptor_bin):
+		if number == 1:
+			name = descriptor_bin[start:end].decode('utf-8')
+		elif number == 3:
+			deps.append(descriptor_bin[start:end].decode('utf-8'))
+	return name, deps
+
+def FileSetIndex(descriptor_bin):
+	# {name: (serialized FileDescriptorProto, dependency)} of a serialized FileDescriptorSet
+	files = {}
+	for number, start, end in LengthDelimitedFields(descriptor_bin):
+		if number == 1:
+			file = descriptor_bin[start:end]
+			name, dependency = FileNameAndDeps(file)
+			files[name] = (file, dependency)
+	return files
+
+def DescriptorNames(descriptor_bin):
+	# {full name: is message} of the messages and enums of a serialized FileDescriptorProto
+	names = {}
+
+	def walk(prefix, start, end, is_message):
+		fields = list(LengthDelimitedFields(descriptor_bin, start, end))
+		name = prefix + [descriptor_bin[s:e].decode('utf-8') for number, s, e in fields if number == 1][0]
+		names[name] = is_message
+		if is_message:
+			for number, s, e in fields:
+				if number in (3, 4): # nested_type, enum_type
+					walk(name + '.', s, e, number == 3)
+
+	fields = list(LengthDelimitedFields(descriptor_bin))
+	package = ''
+	for number, start, end in fields:
+		if number == 2:
+			package = descriptor_bin[start:end].decode('utf-8') + '.'
+	for number, start, end in fields:
+		if number in (4, 5): # message_type, enum_type
+			walk(package, start, end, number == 4)
+	return names
+
 class FDPLinker:
 
 	def __init__(self):
@@ -114,6 +194,35 @@ class FDPLinker:
 
 		walk2([], fdp.message_type, fdp.extension)
 
+	def remove(self, fdp):
+		# forget what add and add_pb2 recorded for the items of fdp
+
+		def fqname(name_components):
+			fq = "." + ".".join(name_components)
+			if len(fdp.package):
+				fq = "." + fdp.package + fq
+			return fq
+
+		def forget(item):
+			for d in (self._containing_type, self._message_of_field, self._enum_of_field,
+					self._extension_scope, self._is_extension, self._obj2pb2):
+				d.pop(id(item), None)
+
+		def walk(name, messages, extensions, enums):
+			for enum in enums:
+				del self._names[fqname(name + [enum.name])]
+				forget(enum)
+			for msg in messages:
+				del self._names[fqname(name + [msg.name])]
+				forget(msg)
+				for field in msg.field:
+					forget(field)
+				walk(name + [msg.name], msg.nested_type, msg.extension, msg.enum_type)
+			for ext in extensions:
+				forget(ext)
+
+		walk([], fdp.message_type, fdp.extension, fdp.enum_type)
+
 	def containing_type(self, item):
 		return self._containing_type[id(item)]
 
@@ -135,34 +244,98 @@ class FDPLinker:
 	def pb2(self, obj):
 		return self._obj2pb2.get(id(obj), None)
 
+# bump when the generated source changes
+_CACHE_VERSION = b'1'
+
 class DynFDP:
 
 	"""
 		no checks that fdp is valid protoc product
 		no groups
 		no services
+
+		with cache_dir the module is also written there as _pb2 source,
+		named after a hash of descriptor_bin and of its deps, and later
+		loaded from it (and its .pyc) instead of being built again.
+		deps are the DynFDP of the files this one depends on, by name,
+		the cache needs them when there are any.
 	"""
 
-	def __init__(self, descriptor_bin, fdp=None, linker=None):
+	def __init__(self, descriptor_bin, fdp=None, linker=None, cache_dir=None, deps=None):
 
 		# can only pass exactly one of them
 		assert (descriptor_bin is None) != (fdp is None)
 
-		if descriptor_bin is None:
-			self.descriptor_bin = fdp.SerializeToString()
-			self.fdp = fdp
+		# a module loaded from the cache needs neither of them, until linked
+		self._descriptor_bin = descriptor_bin
+		self._fdp = fdp
+
+		if fdp is None:
+			self.name, dependency = FileNameAndDeps(descriptor_bin)
 		else:
-			self.descriptor_bin = descriptor_bin
-			self.fdp = descriptor_pb2.FileDescriptorProto()
-			self.fdp.ParseFromString(descriptor_bin)
+			self.name, dependency = str(fdp.name), [str(dep) for dep in fdp.dependency]
 
 		if linker is None:
 			self.linker = FDPLinker()
 		else:
 			self.linker = linker
 
+		self.deps = deps or {}
+		self.linked = False
+		self._intervals = None
+
+		if cache_dir is not None:
+			assert all(dep in self.deps for dep in dependency)
+			h = hashlib.sha1(_CACHE_VERSION + google.protobuf.__version__.encode() + self.descriptor_bin)
+			for name in sorted(self.deps):
+				h.update(self.deps[name].cache_key.encode())
+			self.cache_key = h.hexdigest()
+			path = os.path.join(cache_dir, '%s-%s.py' % (ModuleName(self.name), self.cache_key))
+			if os.path.exists(path):
+				self.module = self.LoadSource(path)
+				return
+		else:
+			self.cache_key = None
+
+		self.Link()
+		self.Build()
+
+		if cache_dir is not None:
+			self.WriteSource(path)
+
+	@property
+	def descriptor_bin(self):
+		if self._descriptor_bin is None:
+			self._descriptor_bin = self._fdp.SerializeToString()
+		return self._descriptor_bin
+
+	@property
+	def fdp(self):
+		if self._fdp is None:
+			self._fdp = descriptor_pb2.FileDescriptorProto()
+			self._fdp.ParseFromString(self._descriptor_bin)
+		return self._fdp
+
+	def Link(self):
+		# a module loaded from the cache is linked only if another file needs it
+		if self.linked:
+			return
+		for dep in self.deps.values():
+			dep.Link()
 		self.linker.add(self.fdp)
-
+		self.linked = True
+		if not hasattr(self, 'module'):
+			return
+
+		def AddPb2(messages, enums):
+			for enum_type in enums:
+				self.linker.add_pb2(enum_type, getattr(self.module, self.ModuleLevelDescriptorName(enum_type)))
+			for message_type in messages:
+				AddPb2(message_type.nested_type, message_type.enum_type)
+				self.linker.add_pb2(message_type, getattr(self.module, self.ModuleLevelDescriptorName(message_type)))
+		AddPb2(self.fdp.message_type, self.fdp.enum_type)
+
+	def Build(self):
 		self.module = type(__import__('sys'))(ModuleName(str(self.fdp.name)))
 		setattr(self.module, 'descriptor', descriptor)
 		setattr(self.module, 'message', message)
@@ -213,9 +386,30 @@ class DynFDP:
 		return str(name)
 
 	def SerializedPbInterval(self, item):
-		s = item.SerializeToString()
-		pos = self.descriptor_bin.index(s)
-		return pos, pos + len(s)
+		if self._intervals is None:
+			self._intervals = self.SerializedPbIntervals()
+		return self._intervals[id(item)]
+
+	def SerializedPbIntervals(self):
+		# (start, end) in descriptor_bin of every message and enum, by id of its
+		# proto in self.fdp, found in one pass over the wire format, the n-th
+		# message_type field being fdp.message_type[n] and so on
+		intervals = {}
+
+		def walk(start, end, messages, enums, messages_number, enums_number):
+			next_message = next_enum = 0
+			for number, s, e in LengthDelimitedFields(self.descriptor_bin, start, end):
+				if number == messages_number:
+					msg = messages[next_message]
+					next_message += 1
+					intervals[id(msg)] = (s, e)
+					walk(s, e, msg.nested_type, msg.enum_type, 3, 4) # DescriptorProto.nested_type, enum_type
+				elif number == enums_number:
+					intervals[id(enums[next_enum])] = (s, e)
+					next_enum += 1
+
+		walk(0, len(self.descriptor_bin), self.fdp.message_type, self.fdp.enum_type, 4, 5) # FileDescriptorProto.message_type, enum_type
+		return intervals
 
 	def OptionsValue(self, class_name, options):
 		serialized = options.SerializeToString()
@@ -451,35 +645,340 @@ class DynFDP:
 		for msg in self.fdp.message_type:
 			FixForeignFieldsInNestedExtensions(msg)
 
+	def LoadSource(self, path):
+		spec = importlib.util.spec_from_file_location(ModuleName(self.name), path)
+		module = importlib.util.module_from_spec(spec)
+		module._deps = dict((name, dep.module) for name, dep in self.deps.items())
+		spec.loader.exec_module(module)
+		return module
+
+	def WriteSource(self, path):
+		source = PySource(self).Source()
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+			with os.fdopen(fd, 'w') as f:
+				f.write(source)
+			os.rename(tmp, path)
+			# written here rather than on first import, which may not write bytecode
+			py_compile.compile(path, doraise=True)
+		except (OSError, py_compile.PyCompileError):
+			pass # no cache then, the module is built already
+
+class PySource:
+
+	"""
+		_pb2 source of a built DynFDP module, the same statements the Print*
+		and Fix* passes run, as protoc used to write them. foreign descriptors
+		are reached through _deps, which the loader sets.
+	"""
+
+	def __init__(self, dyn):
+		self.dyn = dyn
+		self.lines = []
+
+	def Literal(self, value):
+		if isinstance(value, float) and (value != value or value in (float('inf'), float('-inf'))):
+			return "float('%r')" % value
+		if isinstance(value, list):
+			return '[' + ', '.join(self.Literal(v) for v in value) + ']'
+		return repr(value)
+
+	def Options(self, class_name, options):
+		serialized = options.SerializeToString()
+		if len(serialized) == 0:
+			return 'None'
+		return 'descriptor._ParseOptions(descriptor_pb2.%s(), %r)' % (class_name, serialized)
+
+	def Call(self, func, kvargs, indent):
+		pad = '\t' * (indent + 1)
+		return '%s(\n%s%s)' % (func, ''.join('%s%s=%s,\n' % (pad, k, v) for k, v in kvargs), '\t' * indent)
+
+	def Descriptor(self, item):
+		pb2 = self.dyn.linker.pb2(item)
+		name = self.dyn.ModuleLevelDescriptorName(item)
+		if pb2.file.name == self.dyn.fdp.name:
+			return name
+		return '_deps[%r].%s' % (str(pb2.file.name), name)
+
+	def EnumDescriptor(self, item):
+		ss, se = self.dyn.SerializedPbInterval(item)
+		values = [self.Call('descriptor.EnumValueDescriptor', [
+			('name', repr(str(value.name))),
+			('index', repr(index)),
+			('number', repr(value.number)),
+			('options', self.Options('EnumValueOptions', value.options)),
+			('type', 'None'),
+		], 2) for index, value in enumerate(item.value)]
+		return self.Call('descriptor.EnumDescriptor', [
+			('name', repr(str(item.name))),
+			('full_name', repr(self.dyn.FullName(item))),
+			('filename', 'None'),
+			('file', 'DESCRIPTOR'),
+			('values', '[\n\t\t' + ',\n\t\t'.join(values) + ',\n\t]' if len(values) else '[]'),
+			('containing_type', 'None'),
+			('options', self.Options('EnumOptions', item.options)),
+			('serialized_start', repr(ss)),
+			('serialized_end', repr(se)),
+		], 0)
+
+	def FieldDescriptor(self, index, field, is_extension, indent):
+		return self.Call('descriptor.FieldDescriptor', [
+			('name', repr(str(field.name))),
+			('full_name', repr(self.dyn.FullName(field))),
+			('index', repr(index)),
+			('number', repr(field.number)),
+			('type', repr(field.type)),
+			('cpp_type', repr(GetCppType(field.type))),
+			('label', repr(field.label)),
+			('has_default_value', repr(field.HasField('default_value'))),
+			('default_value', self.Literal(self.dyn.StringifyDefaultValue(field))),
+			('message_type', 'None'),
+			('enum_type', 'None'),
+			('containing_type', 'None'),
+			('is_extension', repr(is_extension)),
+			('extension_scope', 'None'),
+			('options', self.Options('FieldOptions', field.options)),
+		], indent)
+
+	def Fields(self, is_extension, lst):
+		if not len(lst):
+			return '[]'
+		return '[\n\t\t' + ',\n\t\t'.join(self.FieldDescriptor(index, field, is_extension, 2)
+			for index, field in enumerate(lst)) + ',\n\t]'
+
+	def MessageDescriptor(self, msg):
+		ss, se = self.dyn.SerializedPbInterval(msg)
+		names = lambda items: '[' + ', '.join(self.dyn.ModuleLevelDescriptorName(item) for item in items) + ']'
+		return self.Call('descriptor.Descriptor', [
+			('name', repr(str(msg.name))),
+			('full_name', repr(self.dyn.FullName(msg))),
+			('filename', 'None'),
+			('file', 'DESCRIPTOR'),
+			('containing_type', 'None'),
+			('fields', self.Fields(False, msg.field)),
+			('extensions', self.Fields(True, msg.extension)),
+			('nested_types', names(msg.nested_type)),
+			('enum_types', names(msg.enum_type)),
+			('options', self.Options('MessageOptions', msg.options)),
+			('is_extendable', repr(len(msg.extension_range) > 0)),
+			('extension_ranges', repr([(er.start, er.end) for er in msg.extension_range])),
+			('serialized_start', repr(ss)),
+			('serialized_end', repr(se)),
+		], 0)
+
+	def FieldReferencingExpression(self, msg, field, dict_name):
+		if msg is None:
+			return str(field.name)
+		return '%s.%s[%r]' % (self.dyn.ModuleLevelDescriptorName(msg), dict_name, str(field.name))
+
+	def FixForeignFieldsInField(self, msg, field, dict_name):
+		obj = self.FieldReferencingExpression(msg, field, dict_name)
+		m = self.dyn.linker.message_of_field(field)
+		if m is not None:
+			self.lines.append('%s.message_type = %s' % (obj, self.Descriptor(m)))
+		e = self.dyn.linker.enum_of_field(field)
+		if e is not None:
+			self.lines.append('%s.enum_type = %s' % (obj, self.Descriptor(e)))
+
+	def FixForeignFieldsInDescriptor(self, msg, parent):
+		for message_type in msg.nested_type:
+			self.FixForeignFieldsInDescriptor(message_type, msg)
+		for field in msg.field:
+			self.FixForeignFieldsInField(msg, field, 'fields_by_name')
+		name = self.dyn.ModuleLevelDescriptorName
+		if parent is not None:
+			self.lines.append('%s.containing_type = %s' % (name(msg), name(parent)))
+		for enum_type in msg.enum_type:
+			self.lines.append('%s.containing_type = %s' % (name(enum_type), name(msg)))
+
+	def MessageClass(self, msg, indent):
+		pad = '\t' * (indent + 1)
+		attrs = [
+			"%s'DESCRIPTOR': %s,\n" % (pad, self.dyn.ModuleLevelDescriptorName(msg)),
+			"%s'__metaclass__': reflection.GeneratedProtocolMessageType,\n" % pad,
+		] + ['%s%r: %s,\n' % (pad, str(nested.name), self.MessageClass(nested, indent + 1)) for nested in msg.nested_type]
+		return 'reflection.GeneratedProtocolMessageType(%r, (message.Message,), {\n%s%s})' % (
+			str(msg.name), ''.join(attrs), '\t' * indent)
+
+	def Source(self):
+		dyn = self.dyn
+		fdp = dyn.fdp
+		out = self.lines
+		out.append('# Generated by pb_tools.dynproto from %s, do not edit' % fdp.name)
+		out.append('')
+		out.append('from google.protobuf import descriptor')
+		out.append('from google.protobuf import message')
+		out.append('from google.protobuf import reflection')
+		out.append('from google.protobuf import descriptor_pb2')
+		out.append('')
+		out.append('DESCRIPTOR = descriptor.FileDescriptor(name=%r, package=%r, serialized_pb=%r)' % (
+			str(fdp.name), str(fdp.package), dyn.descriptor_bin))
+		out.append('')
+
+		for enum_type in fdp.enum_type:
+			out.append('%s = %s' % (dyn.ModuleLevelDescriptorName(enum_type), self.EnumDescriptor(enum_type)))
+			for ev in enum_type.value:
+				out.append('%s = %r' % (ev.name, ev.number))
+		for index, field in enumerate(fdp.extension):
+			out.append('%s_FIELD_NUMBER = %r' % (str(field.name).upper(), field.number))
+			out.append('%s = %s' % (field.name, self.FieldDescriptor(index, field, True, 0)))
+
+		def NestedEnums(msg):
+			for message_type in msg.nested_type:
+				NestedEnums(message_type)
+			for enum_type in msg.enum_type:
+				out.append('%s = %s' % (dyn.ModuleLevelDescriptorName(enum_type), self.EnumDescriptor(enum_type)))
+		for message_type in fdp.message_type:
+			NestedEnums(message_type)
+
+		def Descriptors(msg):
+			for message_type in msg.nested_type:
+				Descriptors(message_type)
+			out.append('%s = %s' % (dyn.ModuleLevelDescriptorName(msg), self.MessageDescriptor(msg)))
+		for message_type in fdp.message_type:
+			Descriptors(message_type)
+		out.append('')
+
+		for message_type in fdp.message_type:
+			self.FixForeignFieldsInDescriptor(message_type, None)
+		for message_type in fdp.message_type:
+			out.append('DESCRIPTOR.message_types_by_name[%r] = %s' % (str(message_type.name), dyn.ModuleLevelDescriptorName(message_type)))
+		out.append('')
+
+		for message_type in fdp.message_type:
+			out.append('%s = %s' % (message_type.name, self.MessageClass(message_type, 0)))
+		out.append('')
+
+		def Extension(ext):
+			parent = dyn.linker.containing_type(ext)
+			self.FixForeignFieldsInField(parent, ext, 'extensions_by_name')
+			out.append('%s.RegisterExtension(%s)' % (
+				dyn.ModuleLevelMessageName(dyn.linker.extension_scope(ext)),
+				self.FieldReferencingExpression(parent, ext, 'extensions_by_name')))
+		def NestedExtensions(msg):
+			for m in msg.nested_type:
+				NestedExtensions(m)
+			for ext in msg.extension:
+				Extension(ext)
+		for ext in fdp.extension:
+			Extension(ext)
+		for msg in fdp.message_type:
+			NestedExtensions(msg)
+
+		out.append('')
+		return '\n'.join(out)
+
 class DynFDS:
 
-	def __init__(self, descriptor_bin):
+	"""
+		builds a DynFDP for every file of a FileDescriptorSet, by name in
+		self.fdp. lazy builds only the files asked for with get_file or
+		get_message, and their dependencies:
 
-		self.descriptor_bin = descriptor_bin
+		fds = DynFDS(descriptor_bin, lazy=True)
+		user = fds.get_message('meetmaker.user')()
+
+		update takes a new version of the set and rebuilds only the files
+		which changed and the files depending on them, modules of the
+		others are kept. threads may share it, files are built and linked
+		one at a time.
+	"""
 
-		self.fds = descriptor_pb2.FileDescriptorSet()
-		self.fds.ParseFromString(descriptor_bin)
+	def __init__(self, descriptor_bin, cache_dir=None, lazy=False):
+
+		self.cache_dir = cache_dir
+		self.lazy = lazy
 
 		self.linker = FDPLinker()
+		self._lock = threading.RLock()
 
 		self.fdp = {}
 
-		files = {}
-
-		for file in self.fds.file:
-			files[str(file.name)] = file
+		self._reset(descriptor_bin)
 
-		def add(name, trace):
-			if name in self.fdp:
-				return
-			if name in trace:
-				raise Exception("cyclic dependencies detected: %s -> %s" % (name, trace))
-			file = files[name]
-			for dep in file.dependency:
-				if dep not in files:
-					raise Exception("missing dependency: %s -> %s" % (name, dep))
-				add(str(dep), trace + [name])
-			self.fdp[name] = DynFDP(None, file, self.linker)
-
-		for name in files.keys():
-			add(name, [])
+	def _reset(self, descriptor_bin):
+		self.descriptor_bin = descriptor_bin
+		self._fds = None
+		self._names = None
+
+		# files are parsed one by one by DynFDP, only when built and not cached
+		self.files = FileSetIndex(descriptor_bin)
+
+		if not self.lazy:
+			for name in self.files.keys():
+				self.get_file(name)
+
+	def update(self, descriptor_bin):
+		# returns names of the files dropped, still present ones are built again (on access if lazy)
+		with self._lock:
+			return self._update(descriptor_bin)
+
+	def _update(self, descriptor_bin):
+		files = FileSetIndex(descriptor_bin)
+
+		dependents = {}
+		for name, (file, dependency) in self.files.items():
+			for dep in dependency:
+				dependents.setdefault(dep, []).append(name)
+
+		stale = set()
+		changed = [name for name in self.files if name not in files or files[name][0] != self.files[name][0]]
+		while len(changed):
+			name = changed.pop()
+			if name not in stale:
+				stale.add(name)
+				changed.extend(dependents.get(name, []))
+
+		for name in stale:
+			dyn = self.fdp.pop(name, None)
+			if dyn is not None and dyn.linked:
+				self.linker.remove(dyn.fdp)
+
+		self._reset(descriptor_bin)
+		return sorted(stale)
+
+	def get_file(self, name, trace=()):
+		with self._lock:
+			return self._get_file(name, trace)
+
+	def _get_file(self, name, trace):
+		if name in self.fdp:
+			return self.fdp[name]
+		if name in trace:
+			raise Exception("cyclic dependencies detected: %s -> %s" % (name, list(trace)))
+		file, dependency = self.files[name]
+		for dep in dependency:
+			if dep not in self.files:
+				raise Exception("missing dependency: %s -> %s" % (name, dep))
+			self._get_file(dep, trace + (name,))
+		deps = dict((dep, self.fdp[dep]) for dep in dependency)
+		self.fdp[name] = DynFDP(file, None, self.linker, self.cache_dir, deps)
+		return self.fdp[name]
+
+	def get_message(self, full_name):
+		# message class by its full name, 'package.Outer.Inner'
+		full_name = full_name.lstrip('.')
+		with self._lock:
+			if self._names is None:
+				names = {}
+				for name, (file, dependency) in self.files.items():
+					for item, is_message in DescriptorNames(file).items():
+						names[item] = (name, is_message)
+				self._names = names
+			file_name, is_message = self._names.get(full_name, (None, False))
+			if not is_message:
+				raise KeyError("message %s not found" % full_name)
+			dyn = self._get_file(file_name, ())
+		package = dyn.module.DESCRIPTOR.package
+		obj = dyn.module
+		for name in full_name[len(package) + 1 if len(package) else 0:].split('.'):
+			obj = getattr(obj, name)
+		return obj
+
+	@property
+	def fds(self):
+		if self._fds is None:
+			self._fds = descriptor_pb2.FileDescriptorSet()
+			self._fds.ParseFromString(self.descriptor_bin)
+		return self._fds
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+'''
+Batch conversion of messages of one type into typed columns, one per field:
+
+	columns = pb2columns(users, fields=['user_id', 'gender', 'photos', 'location.city_id'])
+	columns['user_id']		# numpy.ndarray of int64
+	columns['gender']		# EnumColumn(codes=ndarray of int32, names={1: 'MALE', 2: 'FEMALE'})
+	columns['photos']		# RepeatedColumn(offsets=ndarray of len(users)+1, values=ndarray)
+
+Values of the i-th repeated field are values[offsets[i]:offsets[i + 1]].
+Numeric and enum fields come out as numpy arrays, or as array.array when
+numpy is not installed. String and bytes fields come out as numpy object
+arrays, or as lists.
+'''
+
+import array
+import operator
+import itertools
+import collections
+import collections.abc
+from pb_tools.protobuf_json import ParseError, FD, _ftype2js
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+RepeatedColumn = collections.namedtuple('RepeatedColumn', 'offsets values')
+EnumColumn = collections.namedtuple('EnumColumn', 'codes names')
+
+
+def pb2columns(messages, fields=None, descriptor=None):
+	'''
+		convert a sequence of messages of one type to {field path: column}.
+		fields are names, dotted paths reach into singular nested messages;
+		by default all scalar and enum fields of the top level message.
+		descriptor is only needed to get empty columns from no messages.
+	'''
+	if not isinstance(messages, collections.abc.Sequence):
+		messages = list(messages)
+	if descriptor is None:
+		if not len(messages):
+			return {}
+		descriptor = messages[0].DESCRIPTOR
+	if fields is None:
+		fields = [f.name for f in descriptor.fields if f.type != FD.TYPE_MESSAGE and f.type != FD.TYPE_GROUP]
+	columns = [_column_maker(descriptor, path) for path in fields]
+	if not len(columns):
+		return {}
+
+	# one pass over the messages picks all the values, then transpose
+	rows = map(operator.attrgetter(*fields), messages)
+	if len(fields) == 1:
+		values = [list(rows)]
+	else:
+		values = list(zip(*rows)) or [()] * len(fields)
+	return dict((path, make(v)) for path, make, v in zip(fields, columns, values))
+
+
+# (numpy dtype, array.array typecode) by field type,
+# the other types known to protobuf_json are kept as objects
+_dtypes = {
+	FD.TYPE_DOUBLE: ('float64', 'd'),
+	FD.TYPE_FLOAT: ('float32', 'f'),
+	FD.TYPE_INT64: ('int64', 'q'),
+	FD.TYPE_UINT64: ('uint64', 'Q'),
+	FD.TYPE_INT32: ('int32', 'i'),
+	FD.TYPE_FIXED64: ('uint64', 'Q'),
+	FD.TYPE_FIXED32: ('uint32', 'I'),
+	FD.TYPE_BOOL: ('bool', 'B'),
+	FD.TYPE_UINT32: ('uint32', 'I'),
+	FD.TYPE_ENUM: ('int32', 'i'),
+	FD.TYPE_SFIXED32: ('int32', 'i'),
+	FD.TYPE_SFIXED64: ('int64', 'q'),
+	FD.TYPE_SINT32: ('int32', 'i'),
+	FD.TYPE_SINT64: ('int64', 'q'),
+}
+
+
+def _resolve(descriptor, path):
+	field = None
+	for name in path.split('.'):
+		if field is not None:
+			if field.type != FD.TYPE_MESSAGE or field.label == FD.LABEL_REPEATED:
+				raise ParseError("Field %s is not a singular message, can't get %s" % (field.full_name, path))
+			descriptor = field.message_type
+		field = descriptor.fields_by_name.get(name)
+		if field is None:
+			raise ParseError("Message %s has no field %s" % (descriptor.full_name, name))
+	return field
+
+
+def _column_maker(descriptor, path):
+	''' function turning the list of values of the field at path into its column '''
+	field = _resolve(descriptor, path)
+	if field.type in _dtypes:
+		dtype, typecode = _dtypes[field.type]
+		if numpy is not None:
+			make = lambda values, count=-1: numpy.fromiter(values, dtype, count)
+		else:
+			make = lambda values, count=-1: array.array(typecode, values)
+	elif field.type in _ftype2js:
+		if numpy is not None:
+			make = lambda values, count=-1: numpy.fromiter(values, object, count)
+		else:
+			make = lambda values, count=-1: list(values)
+	else:
+		raise ParseError("Field %s of type '%d' can't be a column" % (field.full_name, field.type))
+
+	if field.type == FD.TYPE_ENUM:
+		names = dict((v.number, v.name) for v in field.enum_type.values)
+		make_values = make
+		make = lambda values, count=-1: EnumColumn(make_values(values, count), names)
+
+	if field.label != FD.LABEL_REPEATED:
+		return lambda values: make(values, len(values))
+
+	def make_repeated(values):
+		offsets = list(itertools.accumulate(map(len, values), initial=0))
+		return RepeatedColumn(_offsets(offsets), make(itertools.chain.from_iterable(values), offsets[-1]))
+	return make_repeated
+
+
+def _offsets(offsets):
+	if numpy is not None:
+		return numpy.array(offsets, 'int64')
+	return array.array('q', offsets)
@@ -3,11 +3,35 @@
 # (c) 2010-2015, Andrei Nigmatulin
 
 import os
+import sys
+import json
+import bisect
 import socket
+import signal
+import selectors
 import struct
-import asyncore
+import time
+import weakref
+import traceback
+import threading
+import itertools
+import collections
+import concurrent.futures
+try:
+	import asyncore
+	_dispatcher = asyncore.dispatcher
+except ImportError:  # removed in python 3.12, use aiopbservice.AsyncPBServer
+	asyncore = None
+	_dispatcher = object
 from pb_tools.protobuf_json import json2pb
 
+_READ_CHUNK = 65536
+METRICS_MSGID = 0xffffff01  # reserved, answered with the server metrics as JSON when metrics_request=True
+_HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+try:
+	_IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+	_IOV_MAX = 16
 
 class IOFailed(Exception):
 	pass
@@ -15,6 +39,365 @@ class IOFailed(Exception):
 class IncorrectUse(Exception):
 	pass
 
+class MessageCodec(object):
+
+	"""
+		msgid tables of a proto module, built once per module:
+		message class -> msgid for encoding, msgid -> class and handler
+		name for decoding and dispatch. codecs do not keep their module
+		alive, a dropped module (a reloaded DynFDS one) takes its codec along.
+	"""
+
+	_codecs = weakref.WeakKeyDictionary()
+	_header = struct.Struct('!II')
+
+	@classmethod
+	def for_module(cls, proto):
+		codec = cls._codecs.get(proto)
+		if codec is None:
+			codec = cls._codecs[proto] = cls(proto)
+		return codec
+
+	def __init__(self, proto):
+		self.msgids = {}  # message class -> msgid
+		self.msgids_by_name = {}  # message name -> msgid, for classes of another copy of the module
+		self.requests = {}  # msgid -> message class
+		self.responses = {}  # msgid -> message class
+		self.handler_names = {}  # request msgid -> handler name
+		self.request_makers = {}  # stub name -> request builder, see common._request_maker
+
+		for enum, classes in ((getattr(proto, '_REQUEST_MSGID', None), self.requests), (getattr(proto, '_RESPONSE_MSGID', None), self.responses)):
+			if enum is None:
+				continue
+			for value in enum.values:
+				name = value.name.lower()
+				msg_class = getattr(proto, name, None)
+				if msg_class is None:
+					continue
+				self.msgids[msg_class] = value.number
+				self.msgids_by_name[name] = value.number
+				classes[value.number] = msg_class
+				if classes is self.requests:
+					self.handler_names[value.number] = name
+
+	def encode(self, msg):
+		msgid = self.msgids.get(msg.__class__)
+		if msgid is None:
+			msgid = self.msgids_by_name.get(msg.DESCRIPTOR.name)
+			if msgid is None:
+				raise IncorrectUse("can't encode message %s" % msg.DESCRIPTOR.name)
+		body = msg.SerializeToString()
+		return self._header.pack(4 + len(body), msgid) + body
+
+	@staticmethod
+	def decode(classes, msgid, body):
+		msg = classes[msgid]()
+		msg.ParseFromString(body)
+		return msg
+
+class Metrics(object):
+
+	"""
+		per message name counters and latency histograms, shared by threads:
+
+		calls, failures (IOFailed or handler exceptions), errors (response_generic
+		with error_code != 0, by code in error_codes), bytes_in, bytes_out, and
+		for every phase (connect, encode, send, wait, decode, queue, handle,
+		total) count, sum, max seconds and counts of calls up to each bound.
+
+		pass metrics=True (or a Metrics to share) to PBService, PBServicePool,
+		PBServer and their asyncio versions, metrics_snapshot() returns a copy.
+	"""
+
+	bounds = tuple(0.00005 * 2 ** i for i in range(20))  # 50us .. 26s, the last bucket is for slower ones
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._methods = {}
+
+	@classmethod
+	def from_kvargs(cls, kvargs):
+		metrics = kvargs.get('metrics')
+		if metrics is True:
+			return cls()
+		return metrics or None
+
+	def record(self, name, phases=(), calls=0, failures=0, bytes_in=0, bytes_out=0, error_code=0):
+		with self._lock:
+			m = self._methods.get(name)
+			if m is None:
+				m = self._methods[name] = {'calls': 0, 'failures': 0, 'errors': 0, 'error_codes': {},
+					'bytes_in': 0, 'bytes_out': 0, 'phases': {}}
+			m['calls'] += calls
+			m['failures'] += failures
+			m['bytes_in'] += bytes_in
+			m['bytes_out'] += bytes_out
+			if error_code:
+				m['errors'] += 1
+				m['error_codes'][error_code] = m['error_codes'].get(error_code, 0) + 1
+			for phase, seconds in phases:
+				h = m['phases'].get(phase)
+				if h is None:
+					h = m['phases'][phase] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.bounds) + 1)}
+				h['count'] += 1
+				h['sum'] += seconds
+				if seconds > h['max']:
+					h['max'] = seconds
+				h['buckets'][bisect.bisect_left(self.bounds, seconds)] += 1
+
+	def snapshot(self):
+		with self._lock:
+			methods = {}
+			for name, m in self._methods.items():
+				m = dict(m, error_codes=dict(m['error_codes']))
+				m['phases'] = dict((phase, dict(h, buckets=list(h['buckets']), avg=h['sum'] / h['count']))
+					for phase, h in m['phases'].items())
+				methods[name] = m
+		return {'bounds': list(self.bounds), 'methods': methods}
+
+	def reset(self):
+		with self._lock:
+			self._methods = {}
+
+class _LRUCache(object):
+
+	"""
+		entries expiring after their ttl, past max_entries or max_bytes the
+		least recently used go first. an entry larger than max_bytes is not
+		cached at all, rather than flushing everything else
+	"""
+
+	def __init__(self, max_entries, max_bytes):
+		self._max_entries = max_entries
+		self._max_bytes = max_bytes
+		self._lock = threading.Lock()
+		self._entries = collections.OrderedDict()  # key -> (expires, size, value)
+		self._bytes = 0
+		self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0, 'oversized': 0}
+
+	def _drop(self, key):
+		expires, size, value = self._entries.pop(key)
+		self._bytes -= size
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and entry[0] <= time.monotonic():
+				self._drop(key)
+				self._stats['expired'] += 1
+				entry = None
+			if entry is None:
+				self._stats['misses'] += 1
+				return None
+			self._entries.move_to_end(key)
+			self._stats['hits'] += 1
+			return entry[2]
+
+	def put(self, key, value, size, ttl):
+		with self._lock:
+			if key in self._entries:
+				self._drop(key)
+			if self._max_bytes is not None and size > self._max_bytes:
+				self._stats['oversized'] += 1
+				return
+			self._entries[key] = (time.monotonic() + ttl, size, value)
+			self._bytes += size
+			while len(self._entries) > self._max_entries or (self._max_bytes is not None and self._bytes > self._max_bytes):
+				self._drop(next(iter(self._entries)))
+				self._stats['evictions'] += 1
+
+	def invalidate(self, match=None):
+		""" drops the entries whose key match(key) is true, all of them by default """
+		with self._lock:
+			keys = [key for key in self._entries if match is None or match(key)]
+			for key in keys:
+				self._drop(key)
+			self._stats['invalidations'] += len(keys)
+
+	def stats(self):
+		with self._lock:
+			return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+
+class ResponseCache(_LRUCache):
+
+	"""
+		client side cache of responses to idempotent requests, shared by the
+		PBService or PBServicePool it is passed to as response_cache=:
+
+		cache = ResponseCache({'user_get': 30, 'city_list': 600}, max_entries=100000)
+		svc = PBService(host='127.0.0.1', port=11013, proto='meetmaker', response_cache=cache)
+
+		only the listed methods are cached, each for its ttl in seconds, keyed
+		by the request message name and serialized request. error responses
+		are not cached. past max_entries, or max_bytes of cached requests and
+		responses, the least recently used entries go first. every hit parses
+		a new response, callers may modify it.
+
+		share a cache only between connections to the same service.
+	"""
+
+	def __init__(self, methods, max_entries=10000, max_bytes=None):
+		_LRUCache.__init__(self, max_entries, max_bytes)
+		self._ttls = dict(('request_%s' % name, ttl) for name, ttl in methods.items())
+
+	def ttl(self, name):
+		""" ttl of a request message name, None if it is not cached """
+		return self._ttls.get(name)
+
+	def get(self, key):
+		entry = _LRUCache.get(self, key)
+		if entry is None:
+			return None
+		o = entry[0]()
+		o.ParseFromString(entry[1])
+		return o
+
+	def put(self, key, o, ttl):
+		body = o.SerializeToString()
+		_LRUCache.put(self, key, (type(o), body), len(key[1]) + len(body), ttl)
+
+	def invalidate(self, method=None, req=None):
+		"""
+			drops the response to the pb2 request req, or all the responses of
+			method ('user_get'), or everything
+		"""
+		if req is not None:
+			key = (req.DESCRIPTOR.name, req.SerializeToString())
+			_LRUCache.invalidate(self, lambda k: k == key)
+		elif method is not None:
+			name = 'request_%s' % method
+			_LRUCache.invalidate(self, lambda k: k[0] == name)
+		else:
+			_LRUCache.invalidate(self)
+
+class SingleFlight(object):
+
+	"""
+		concurrent calls of the listed methods with byte-identical requests
+		share one call to the server, all of them get its response (a copy
+		each) or its exception. pass single_flight=['user_get', ...] to
+		PBServicePool or AsyncPBService, stats() counts calls and coalesced
+		calls by method.
+	"""
+
+	def __init__(self, methods):
+		self._names = dict(('request_%s' % method, method) for method in methods)
+		self._lock = threading.Lock()
+		self._flights = {}  # (name, request bytes) -> [done event, response, exception]
+		self._stats = dict((method, {'calls': 0, 'coalesced': 0}) for method in methods)
+
+	def _join(self, req, make_flight):
+		""" (key, flight, True if the caller leads it), flight is None for requests not coalesced """
+		method = self._names.get(req.DESCRIPTOR.name)
+		if method is None:
+			return None, None, False
+		key = (req.DESCRIPTOR.name, req.SerializeToString())
+		with self._lock:
+			stats = self._stats[method]
+			stats['calls'] += 1
+			flight = self._flights.get(key)
+			if flight is not None:
+				stats['coalesced'] += 1
+				return key, flight, False
+			flight = self._flights[key] = [make_flight(), None, None]
+			return key, flight, True
+
+	def _land(self, key, flight, o, e):
+		with self._lock:
+			del self._flights[key]
+		if o is None and e is None:  # the leader was interrupted
+			e = IOFailed("Coalesced call did not complete")
+		flight[1] = o
+		flight[2] = e
+
+	@staticmethod
+	def _result(flight):
+		if flight[2] is not None:
+			raise flight[2]
+		o = type(flight[1])()
+		o.CopyFrom(flight[1])
+		return o
+
+	def call(self, call, req):
+		key, flight, leader = self._join(req, threading.Event)
+		if flight is None:
+			return call(req)
+		if not leader:
+			flight[0].wait()
+			return self._result(flight)
+		o = e = None
+		try:
+			o = call(req)
+			return o
+		except Exception as exc:
+			e = exc
+			raise
+		finally:
+			self._land(key, flight, o, e)
+			flight[0].set()
+
+	def stats(self):
+		with self._lock:
+			return dict((method, dict(stats)) for method, stats in self._stats.items())
+
+class Hook(object):
+
+	"""
+		callbacks around the phases of every call, pass hooks=[...] to PBService,
+		PBServicePool, PBServer or their asyncio versions. without hooks (and
+		metrics) the call path is the plain one.
+
+		name is the request message name, times come from time.perf_counter(),
+		size is the number of bytes of the frame or body handled, or None.
+
+		PBService:       call, and within it connect, encode, send, receive, decode;
+		                 call_many for a whole batch, with name None
+		AsyncPBService:  call, connect, receive (encode, send and decode happen in there)
+		PBServer:        decode, dispatch (the handler, in a thread when offloaded), encode
+
+		hooks of pools, of servers with threads and of AsyncPBService are
+		called concurrently.
+	"""
+
+	def before(self, phase, name, started):
+		pass
+
+	def after(self, phase, name, started, finished, size):
+		pass
+
+	def failed(self, phase, name, started, finished, exc):
+		pass
+
+class ChromeTraceHook(Hook):
+
+	"""
+		keeps a complete event for every phase, write() saves them as a Chrome
+		trace-event file (chrome://tracing, Perfetto), at most max_events
+
+		svc = PBService(host=..., port=..., proto=..., hooks=[ChromeTraceHook('calls.json')])
+	"""
+
+	def __init__(self, path, max_events=1000000):
+		self.path = path
+		self.max_events = max_events
+		self.events = []
+
+	def _event(self, phase, name, started, finished, args):
+		if len(self.events) < self.max_events:
+			self.events.append({'name': phase if name is None else '%s %s' % (phase, name), 'cat': phase, 'ph': 'X',
+				'ts': started * 1e6, 'dur': (finished - started) * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident(),
+				'args': args})
+
+	def after(self, phase, name, started, finished, size):
+		self._event(phase, name, started, finished, {'size': size})
+
+	def failed(self, phase, name, started, finished, exc):
+		self._event(phase, name, started, finished, {'error': repr(exc)})
+
+	def write(self, path=None):
+		with open(path or self.path, 'w') as f:
+			json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
 class common(object):
 
 	def __init__(self, kvargs):
@@ -24,6 +407,7 @@ class common(object):
 			self.proto = kvargs['module']
 		else:
 			self.proto = __import__(kvargs['proto'] + '_pb2')
+		self._codec = MessageCodec.for_module(self.proto)
 		self._io_timeout = 60
 
 		if 'socket' in kvargs:
@@ -42,25 +426,84 @@ class common(object):
 		if 'io_timeout' in kvargs:
 			self._io_timeout = kvargs['io_timeout']
 
+		# messages are received into this buffer, it grows up to recv_buffer_limit
+		# bytes and larger messages get a buffer of their own
+		self._recv_buffer = bytearray(64 * 1024)
+		self._recv_buffer_limit = 4 * 1024 * 1024
+
+		if 'recv_buffer_limit' in kvargs:
+			self._recv_buffer_limit = kvargs['recv_buffer_limit']
+
+		self._metrics = Metrics.from_kvargs(kvargs)
+		self._hooks = tuple(kvargs.get('hooks') or ())
+		self._instrumented = self._metrics is not None or len(self._hooks) > 0
+		self._single_flight = None
+
+	def _before(self, phase, name):
+		t = time.perf_counter()
+		for hook in self._hooks:
+			hook.before(phase, name, t)
+		return t
+
+	def _after(self, phase, name, started, size):
+		""" returns the duration of the phase """
+		t = time.perf_counter()
+		for hook in self._hooks:
+			hook.after(phase, name, started, t, size)
+		return t - started
+
+	def _failed(self, phase, name, started, e):
+		t = time.perf_counter()
+		for hook in self._hooks:
+			hook.failed(phase, name, started, t, e)
+
+	def _record(self, name, *a, **kv):
+		if self._metrics is not None:
+			self._metrics.record(name, *a, **kv)
+
+	def metrics_snapshot(self):
+		""" see Metrics, None unless created with metrics=True """
+		if self._metrics is None:
+			return None
+		return self._metrics.snapshot()
+
 	def _clean_close(self):
 		if self._own_socket:
 			self._sock.close()
 			self._sock = None
 
-	def _recv_n(self, n):
-		buf = b''
+	def _recv_into(self, view):
+		n = len(view)
+		received = 0
 
-		while (len(buf) < n):
-			chunk = self._sock.recv(n - len(buf))
-			if chunk == b'':
+		while received < n:
+			# responses still in flight would answer the next calls, the
+			# connection goes away on any failure
+			try:
+				chunk = self._sock.recv_into(view[received:])
+			except socket.timeout as e:
+				self._clean_close()
+				raise IOFailed("No response in %s seconds" % self._io_timeout) from e
+			except OSError as e:
+				self._clean_close()
+				raise IOFailed("Recv failed: %r" % e)
+			if chunk == 0:
 				break
-			buf += chunk
+			received += chunk
 
-		if len(buf) != n:
+		if received != n:
 			self._clean_close()
-			raise IOFailed("Truncated message: received %d bytes out of %d expected" % (len(buf), n))
+			raise IOFailed("Truncated message: received %d bytes out of %d expected" % (received, n))
 
-		return buf
+		return view
+
+	def _recv_view(self, n):
+		if n > len(self._recv_buffer):
+			if n > self._recv_buffer_limit:
+				return memoryview(bytearray(n))
+			# a new buffer, views of the old one may still be alive
+			self._recv_buffer = bytearray(max(n, min(2 * len(self._recv_buffer), self._recv_buffer_limit)))
+		return memoryview(self._recv_buffer)[:n]
 
 	def _send(self, bytes):
 		try:
@@ -70,48 +513,117 @@ class common(object):
 			raise IOFailed("Send failed")
 
 	def _encode_msg(self, msg):
-		if msg.DESCRIPTOR.name.startswith('request_'):
-			msgid_enum = self.proto._REQUEST_MSGID
-		elif msg.DESCRIPTOR.name.startswith('response_'):
-			msgid_enum = self.proto._RESPONSE_MSGID
-		else:
-			raise IncorrectUse("can't encode message %s" % msg.name)
+		return self._codec.encode(msg)
 
-		msgid_enum_value = msgid_enum.values_by_name[msg.DESCRIPTOR.name.upper()]
-		body = msg.SerializeToString()
-		payload = struct.pack('!II', 4 + len(body), msgid_enum_value.number) + body
+	def _recv_frame(self):
+		msg_len, msgid = struct.unpack('!II', self._recv_into(self._recv_view(8)))
+		if msg_len < 4:
+			self._clean_close()
+			raise IOFailed("Bad message length %d" % msg_len)
 
-		return payload
+		# a view of the receive buffer, valid until the next receive
+		return msgid, self._recv_into(self._recv_view(msg_len - 4))
 
-	def _recv_msg(self, msgid_enum):
-		buf = self._recv_n(4)
-		msg_len = struct.unpack('!I', buf)[0]
+	def _recv_msg(self, classes):
+		# parsed straight from the receive buffer, the message does not keep references to it
+		msgid, body = self._recv_frame()
+		return self._codec.decode(classes, msgid, body)
 
-		buf = self._recv_n(msg_len)
-		msgid = struct.unpack('!I', buf[0:4])[0]
-		body = buf[4:]
+	def _recv_request_msg(self):
+		return self._recv_msg(self._codec.requests)
 
-		msgid_enum_value = msgid_enum.values_by_number[msgid]
-		msg = getattr(self.proto, msgid_enum_value.name.lower())()
-		msg.ParseFromString(body)
+	def _recv_response_msg(self):
+		return self._recv_msg(self._codec.responses)
 
-		return msg
+	def _request_maker(self, name):
+		""" request builder of a stub method, built once per proto module """
+		make_request = self._codec.request_makers.get(name)
+		if make_request is not None:
+			return make_request
+		req_class = getattr(self.proto, 'request_%s' % name, None)
+		proto_name = self.proto.__name__
 
-	def _recv_request_msg(self):
-		return self._recv_msg(self.proto._REQUEST_MSGID)
+		def make_request(a, kv):
+			if len(a):  # arg passed as pb2 object
+				return a[0]
+			# arg passed as dict
+			if req_class is None:
+				raise AttributeError("'%s' has no attribute 'request_%s'" % (proto_name, name))
+			req_pb2 = req_class()
+			json2pb(req_pb2, kv)
+			return req_pb2
 
-	def _recv_response_msg(self):
-		return self._recv_msg(self.proto._RESPONSE_MSGID)
+		self._codec.request_makers[name] = make_request
+		return make_request
+
+	@staticmethod
+	def _cache_stub(obj, name, call):
+		"""
+			stubs are cached on the class, so that instances do not reference
+			themselves and are freed as soon as they are dropped
+		"""
+		if not name.startswith('_'):
+			setattr(type(obj), name, call)  # next calls do not come here
+		return call.__get__(obj)
+
+	def _make_request(self, name, a, kv):
+		return self._request_maker(name)(a, kv)
+
+	def _init_single_flight(self, methods, cls=SingleFlight):
+		self._single_flight = None  # PBServicePool does not run common.__init__
+		if methods:
+			self._single_flight = cls(methods)
+			self._unshared_pb2_call = self._pb2_call
+			self._pb2_call = self._single_flight_pb2_call
+
+	def _single_flight_pb2_call(self, req):
+		return self._single_flight.call(self._unshared_pb2_call, req)
+
+	def single_flight_stats(self):
+		""" see SingleFlight, None unless created with single_flight= """
+		if self._single_flight is None:
+			return None
+		return self._single_flight.stats()
+
+	def _init_response_cache(self, cache):
+		self._response_cache = cache
+		if cache is not None:
+			self._uncached_pb2_call = self._pb2_call
+			self._pb2_call = self._cached_pb2_call
+
+	def _cached_pb2_call(self, req):
+		name = req.DESCRIPTOR.name
+		ttl = self._response_cache.ttl(name)
+		if ttl is None:
+			return self._uncached_pb2_call(req)
+		key = (name, req.SerializeToString())
+		o = self._response_cache.get(key)
+		if o is None:
+			o = self._uncached_pb2_call(req)
+			if not self._is_service_error(o):
+				self._response_cache.put(key, o, ttl)
+		return o
+
+	@staticmethod
+	def _is_service_error(o):
+		return o.DESCRIPTOR.name == 'response_generic' and o.error_code != 0
+
+	@staticmethod
+	def _error_code(o):
+		return o.error_code if common._is_service_error(o) else 0
 
 	@staticmethod
 	def retry_once_on(e):
+		""" but not on a timeout, the call would only wait as long again """
 
 		def deco_retry(f):
 			def f_retry(*args, **kwargs):
 
 				try:
 					return f(*args, **kwargs)
-				except e:
+				except e as err:
+					if isinstance(err.__cause__, socket.timeout):
+						raise
 					return f(*args, **kwargs)
 
 			return f_retry
@@ -124,8 +636,17 @@ class PBService(common):
 		common.__init__(self, kvargs)
 		self._connect_timeout = 30
 
+		self._pipeline_depth = 128
+
 		if 'connect_timeout' in kvargs:
 			self._connect_timeout = kvargs['connect_timeout']
+		if 'pipeline_depth' in kvargs:
+			self._pipeline_depth = kvargs['pipeline_depth']
+
+		if self._instrumented:
+			self._pb2_call = self._instrumented_pb2_call
+			self._pb2_call_many = self._instrumented_pb2_call_many
+		self._init_response_cache(kvargs.get('response_cache'))
 
 	def _connect(self):
 		if self._sock is not None:
@@ -140,6 +661,26 @@ class PBService(common):
 		self._connected = True
 		self._sock.settimeout(self._io_timeout)
 
+	def close(self):
+		if self._sock is not None:
+			self._clean_close()
+
+	def _is_alive(self):
+		""" connected socket has neither EOF nor unread bytes pending """
+		if self._sock is None:
+			return True
+		self._sock.settimeout(0)
+		try:
+			self._sock.recv(1, socket.MSG_PEEK)  # eof or a stray response
+			return False
+		except (BlockingIOError, InterruptedError):
+			return True
+		except socket.error:
+			return False
+		finally:
+			if self._sock is not None:
+				self._sock.settimeout(self._io_timeout)
+
 	@common.retry_once_on(IOFailed)  # connect, recv or send
 	def _pb2_call(self, req):
 		self._connect()
@@ -147,30 +688,338 @@ class PBService(common):
 		self._send(bytes)
 		return self._recv_response_msg()
 
+	def _pb2_call_many(self, reqs):
+		# not retried, the server may have run a part of the batch already.
+		# a connection which went away while idle is replaced beforehand
+		if not self._is_alive():
+			self._clean_close()
+		self._connect()
+		responses = []
+		# at most pipeline_depth requests are in flight
+		for i in range(0, len(reqs), self._pipeline_depth):
+			batch = reqs[i:i + self._pipeline_depth]
+			self._send_reading(b''.join([self._encode_msg(req) for req in batch]), responses)
+			while len(responses) < i + len(batch):
+				responses.append(self._recv_response_msg())
+		return responses
+
+	@common.retry_once_on(IOFailed)  # connect, recv or send
+	def _instrumented_pb2_call(self, req):
+		# _pb2_call with hooks and metrics
+		name = req.DESCRIPTOR.name
+		phases = []
+		call_started = self._before('call', name)
+		try:
+			if self._sock is None:
+				phase, started = 'connect', self._before('connect', name)
+				self._connect()
+				phases.append(('connect', self._after(phase, name, started, None)))
+			phase, started = 'encode', self._before('encode', name)
+			frame = self._encode_msg(req)
+			phases.append(('encode', self._after(phase, name, started, len(frame))))
+			phase, started = 'send', self._before('send', name)
+			self._send(frame)
+			phases.append(('send', self._after(phase, name, started, len(frame))))
+			phase, started = 'receive', self._before('receive', name)
+			msgid, body = self._recv_frame()
+			phases.append(('wait', self._after(phase, name, started, 8 + len(body))))
+			phase, started = 'decode', self._before('decode', name)
+			o = self._codec.decode(self._codec.responses, msgid, body)
+			phases.append(('decode', self._after(phase, name, started, len(body))))
+		except Exception as e:
+			# IOFailed, and an unknown response msgid
+			self._failed(phase, name, started, e)
+			self._failed('call', name, call_started, e)
+			self._record(name, failures=1)
+			raise
+		phases.append(('total', self._after('call', name, call_started, len(frame) + 8 + len(body))))
+		self._record(name, phases, calls=1, bytes_in=8 + len(body), bytes_out=len(frame), error_code=self._error_code(o))
+		return o
+
+	def _instrumented_pb2_call_many(self, reqs):
+		# every request of a batch waits for all of it, that is its total
+		started = self._before('call_many', None)
+		try:
+			responses = PBService._pb2_call_many(self, reqs)
+		except Exception as e:
+			self._failed('call_many', None, started, e)
+			for req in reqs:
+				self._record(req.DESCRIPTOR.name, failures=1)
+			raise
+		total = self._after('call_many', None, started, None)
+		for req, o in zip(reqs, responses):
+			self._record(req.DESCRIPTOR.name, (('total', total),), calls=1,
+				bytes_in=8 + o.ByteSize(), bytes_out=8 + req.ByteSize(), error_code=self._error_code(o))
+		return responses
+
+	@common.retry_once_on(IOFailed)  # connect, recv or send
+	def server_metrics(self):
+		""" metrics_snapshot() and offload_stats() of a server started with metrics_request=True """
+		self._connect()
+		self._send(MessageCodec._header.pack(4, METRICS_MSGID))
+		msgid, body = self._recv_frame()
+		if msgid != METRICS_MSGID:
+			self._clean_close()
+			raise IOFailed("Unexpected response msgid %d" % msgid)
+		return json.loads(body.tobytes().decode('utf-8'))
+
+	def _send_reading(self, payload, responses):
+		"""
+			sends the payload, receiving responses whenever they arrive, so that
+			the server never blocks on writing to us while we block on writing to it
+		"""
+		view = memoryview(payload)
+		sent = 0
+		with selectors.DefaultSelector() as selector:
+			selector.register(self._sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+			while sent < len(view):
+				events = selector.select(self._io_timeout)
+				if not len(events):
+					self._clean_close()
+					raise IOFailed("Send timed out")
+				mask = events[0][1]
+				if mask & selectors.EVENT_WRITE:
+					try:
+						sent += self._sock.send(view[sent:])
+					except socket.error:
+						self._clean_close()
+						raise IOFailed("Send failed")
+				if mask & selectors.EVENT_READ:
+					responses.append(self._recv_response_msg())
+
+	def call_many(self, reqs):
+		"""
+			send all pb2 requests back to back, return responses in the same order.
+			unlike single calls, a batch is not retried on IOFailed
+		"""
+		responses = self._pb2_call_many(list(reqs))
+		self._service_error = None
+		for o in responses:
+			if self._is_service_error(o):
+				self._service_error = o
+				break
+		return responses
+
+	def pipeline(self):
+		return Pipeline(self)
+
 	def __getattr__(self, name):
-		def call(*a, **kv):
-			if len(a):  # arg passed as pb2 object
-				req_pb2 = a[0]
-			else:  # arg passed as dict
-				req_pb2 = getattr(self.proto, 'request_%s' % name)()
-				json2pb(req_pb2, kv)
-			o = self._pb2_call(req_pb2)
-			if o.DESCRIPTOR.name == 'response_generic' and o.error_code != 0:
+		def call(self, *a, **kv):
+			o = self._pb2_call(self._request_maker(name)(a, kv))
+			if self._is_service_error(o):
 				self._service_error = o
 			else:
 				self._service_error = None
 			return o
+		return self._cache_stub(self, name, call)
+
+class PBServicePool(object):
+
+	"""
+		thread safe pool of PBService connections with the same call surface:
+
+		pool = PBServicePool(host='127.0.0.1', port=11013, proto='meetmaker', max_connections=16)
+		pool.user_get(user_id=123)
+
+		connections are opened lazily, at most max_connections of them, and
+		callers wait up to checkout_timeout seconds for a free one. connections
+		idle for more than idle_timeout seconds are closed, keeping at least
+		min_connections around. a connection that failed or found its peer gone
+		is dropped instead of being returned to the pool.
+	"""
+
+	def __init__(self, **kvargs):
+		self._metrics = Metrics.from_kvargs(kvargs)
+		if self._metrics is not None:
+			kvargs = dict(kvargs, metrics=self._metrics)  # one for all connections
+		# hits do not need a connection, the pool looks the cache up itself
+		kvargs = dict(kvargs)
+		self._init_single_flight(kvargs.pop('single_flight', None))
+		self._init_response_cache(kvargs.pop('response_cache', None))
+		self._kvargs = kvargs
+		self._min_connections = 0
+		self._max_connections = 8
+		self._idle_timeout = 60
+		self._checkout_timeout = 30
+
+		if 'min_connections' in kvargs:
+			self._min_connections = kvargs['min_connections']
+		if 'max_connections' in kvargs:
+			self._max_connections = kvargs['max_connections']
+		if 'idle_timeout' in kvargs:
+			self._idle_timeout = kvargs['idle_timeout']
+		if 'checkout_timeout' in kvargs:
+			self._checkout_timeout = kvargs['checkout_timeout']
+
+		if 'socket' in kvargs:
+			raise IncorrectUse("can't pool a single socket")
+		if not 0 <= self._min_connections <= self._max_connections or self._max_connections < 1:
+			raise IncorrectUse("bad pool size %r..%r" % (self._min_connections, self._max_connections))
+
+		self._cond = threading.Condition()
+		self._local = threading.local()
+		self._idle = []  # (conn, last_used), most recently used last
+		self._size = 1
+
+		conn = PBService(**kvargs)
+		self.proto = conn.proto
+		self._codec = conn._codec
+		self._idle.append((conn, time.time()))
+
+	@property
+	def _service_error(self):
+		return getattr(self._local, 'service_error', None)
+
+	def stats(self):
+		with self._cond:
+			return {'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle)}
+
+	metrics_snapshot = common.metrics_snapshot
+
+	def _evict_idle(self, now):
+		while len(self._idle) and self._size > self._min_connections and now - self._idle[0][1] > self._idle_timeout:
+			conn, last_used = self._idle.pop(0)
+			conn.close()
+			self._size -= 1
+
+	def checkout(self):
+		deadline = time.time() + self._checkout_timeout
+		with self._cond:
+			while True:
+				now = time.time()
+				self._evict_idle(now)
+				while len(self._idle):
+					conn, last_used = self._idle.pop()
+					if conn._is_alive():
+						return conn
+					conn.close()
+					self._size -= 1
+				if self._size < self._max_connections:
+					self._size += 1
+					break
+				if now >= deadline:
+					raise IOFailed("no free connection in pool after %s seconds" % self._checkout_timeout)
+				self._cond.wait(deadline - now)
+		# connects lazily on the first call, outside of the lock
+		return PBService(**self._kvargs)
+
+	def checkin(self, conn, broken=False):
+		if broken:
+			conn.close()
+		with self._cond:
+			if broken:
+				self._size -= 1
+			else:
+				self._idle.append((conn, time.time()))
+			self._cond.notify()
+
+	def _run(self, f):
+		conn = self.checkout()
+		try:
+			o = f(conn)
+		except:
+			# stream state is unknown after any failure in the middle of a call
+			self.checkin(conn, broken=True)
+			raise
+		self.checkin(conn)
+		return o
+
+	def close(self):
+		with self._cond:
+			for conn, last_used in self._idle:
+				conn.close()
+				self._size -= 1
+			self._idle = []
+
+	_request_maker = common._request_maker
+	_make_request = common._make_request
+	_init_single_flight = common._init_single_flight
+	_single_flight_pb2_call = common._single_flight_pb2_call
+	single_flight_stats = common.single_flight_stats
+	_init_response_cache = common._init_response_cache
+	_cached_pb2_call = common._cached_pb2_call
+	_is_service_error = staticmethod(common._is_service_error)
+
+	def _pb2_call(self, req):
+		return self._run(lambda conn: conn._pb2_call(req))
+
+	def call_many(self, reqs):
+		reqs = list(reqs)
+		responses = self._run(lambda conn: conn.call_many(reqs))
+		self._local.service_error = None
+		for o in responses:
+			if PBService._is_service_error(o):
+				self._local.service_error = o
+				break
+		return responses
+
+	def pipeline(self):
+		return Pipeline(self)
+
+	def __getattr__(self, name):
+		def call(self, *a, **kv):
+			o = self._pb2_call(self._request_maker(name)(a, kv))
+			if PBService._is_service_error(o):
+				self._local.service_error = o
+			else:
+				self._local.service_error = None
+			return o
+		return common._cache_stub(self, name, call)
+
+class Pipeline(object):
+
+	"""
+		collects calls made with the usual PBService surface and sends them
+		in one go on execute() or on leaving the with block:
+
+		with svc.pipeline() as p:
+			p.user_get(user_id=1)
+			p.user_get(user_id=2)
+		print(p.responses)
+	"""
+
+	def __init__(self, service):
+		self._service = service
+		self._requests = []
+		self.responses = None
+
+	def __getattr__(self, name):
+		def call(*a, **kv):
+			self._requests.append(self._service._make_request(name, a, kv))
 		return call
 
+	def execute(self):
+		requests, self._requests = self._requests, []
+		self.responses = self._service.call_many(requests)
+		return self.responses
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		# nothing left after an explicit execute(), its responses and
+		# service error stay
+		if exc_type is None and len(self._requests):
+			self.execute()
+
+class _RawRequest(object):
+
+	""" request of a reserved msgid, the body is kept as is """
+
+	def ParseFromString(self, body):
+		self.body = bytes(body)
+
 class PBServer(common):
 
-	class ListeningConnection(asyncore.dispatcher):
+	class ListeningConnection(_dispatcher):
 
-		def __init__(self, server):
+		def __init__(self, server, reuse_port=False):
 			asyncore.dispatcher.__init__(self)
 			self._server = server
 			self.create_socket(server._family, socket.SOCK_STREAM)
 			self.set_reuse_addr()
+			if reuse_port:
+				self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 			self.bind(server._addr)
 			self.listen(65535)
 
@@ -178,64 +1027,446 @@ class PBServer(common):
 			sock, address = self.accept()
 			self._server.client_conns.append(self._server.ClientConnection(self._server, sock, address))
 
-	class ClientConnection(asyncore.dispatcher):
+	class Trigger(_dispatcher):
+
+		""" wakes up the loop from handler threads to deliver their responses """
+
+		def __init__(self, server):
+			self._server = server
+			self._wakeup, sock = socket.socketpair()
+			self._wakeup.setblocking(False)
+			asyncore.dispatcher.__init__(self, sock)
+
+		def pull(self):
+			try:
+				self._wakeup.send(b'x')
+			except (BlockingIOError, InterruptedError):
+				pass  # the loop has plenty of wakeups pending already
+
+		def readable(self):
+			return True
+
+		def writable(self):
+			return False
+
+		def handle_read(self):
+			self.recv(4096)
+			completed = self._server._completed
+			while len(completed):
+				conn, slot, frame, exc_info = completed.popleft()
+				if conn.connected:
+					conn.complete(slot, frame, exc_info)
+
+	class ClientConnection(_dispatcher):
 
 		def __init__(self, server, sock, address):
 			asyncore.dispatcher.__init__(self, sock)
 			self._server = server
-			self.write_buffer = b''
-			self.read_buffer = b''
-			self.read_msg_id = None
-			self.read_msg_len = 0
+			self.read_buffer = bytearray(_READ_CHUNK)
+			self.read_start = 0  # first byte not parsed yet
+			self.read_end = 0  # end of received data
+			self.out_queue = collections.deque()  # encoded responses, flushed with one sendmsg
+			self.out_bytes = 0
+			self.pending = collections.deque()  # response slots of offloaded requests, in request order
+			if server._instrumented:
+				self.handle_request = self.instrumented_handle_request
 
 		def readable(self):
-			return len(self.write_buffer) == 0
+			return self.out_bytes < self._server._max_output and len(self.pending) < self._server._max_pipeline
 
 		def writable(self):
-			return len(self.write_buffer) > 0
+			return len(self.out_queue) > 0
+
+		def push(self, frame):
+			self.out_queue.append(frame)
+			self.out_bytes += len(frame)
 
 		def handle_write(self):
-			sent = self.send(self.write_buffer)
-			self.write_buffer = self.write_buffer[sent:]
+			try:
+				if _HAVE_SENDMSG:
+					sent = self.socket.sendmsg(list(itertools.islice(self.out_queue, _IOV_MAX)))
+				else:
+					sent = self.socket.send(self.out_queue[0])
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError as why:
+				if why.errno in asyncore._DISCONNECTED:
+					self.handle_close()
+					return
+				raise
+			self.out_bytes -= sent
+			while sent:
+				frame = self.out_queue[0]
+				if len(frame) > sent:
+					self.out_queue[0] = memoryview(frame)[sent:]
+					break
+				self.out_queue.popleft()
+				sent -= len(frame)
 
 		def handle_close(self):
 			self._server.client_conns.remove(self)
 			self.close()
 
-		def handle_request(self):
-			req_msgid = self._server.proto._REQUEST_MSGID.values_by_number[self.read_msg_id]
-			req = getattr(self._server.proto, req_msgid.name.lower())()
-			req.ParseFromString(self.read_buffer)
-			handler = getattr(self._server, req_msgid.name.lower())
-			res = handler(req)
-			self.write_buffer = self._server._encode_msg(res)
+		def handle_request(self, msgid, body):
+			req_class, handler = self._server._handler(msgid)
+			req = req_class()
+			req.ParseFromString(body)
+			if self._server._offloaded(handler):
+				frame, handler = self._server._cached_offload(handler, req)
+				if frame is None:
+					slot = [None]
+					self.pending.append(slot)
+					self._server._submit(self, slot, handler, req)
+				elif len(self.pending):
+					self.pending.append([frame])
+				else:
+					self.push(frame)
+			elif len(self.pending):
+				self.pending.append([self._server._encode_response(handler(req))])
+			else:
+				self.push(self._server._encode_response(handler(req)))
+
+		def instrumented_handle_request(self, msgid, body):
+			server = self._server
+			req_class, handler, req, name = server._instrumented_decode(msgid, body)
+			if server._offloaded(handler):
+				frame, handler = server._cached_offload(handler, req)
+				if frame is None:
+					slot = [None]
+					self.pending.append(slot)
+					server._submit(self, slot, server._instrumented_offload(name, handler), req)
+					return
+				frame = server._instrumented_response(name, frame, server._before('dispatch', name))
+			else:
+				frame = server._instrumented_call(name, handler, req)
+			if len(self.pending):
+				self.pending.append([frame])
+			else:
+				self.push(frame)
+
+		def complete(self, slot, frame, exc_info):
+			if exc_info is not None:
+				traceback.print_exception(*exc_info)
+				self.handle_close()
+				return
+			slot[0] = frame
+			while len(self.pending) and self.pending[0][0] is not None:
+				self.push(self.pending.popleft()[0])
+
+		def recv_into(self, view):
+			try:
+				n = self.socket.recv_into(view)
+				if n == 0:
+					self.handle_close()
+				return n
+			except (BlockingIOError, InterruptedError):
+				return 0
+			except OSError as why:
+				if why.errno in asyncore._DISCONNECTED:
+					self.handle_close()
+					return 0
+				raise
+
+		def reserve(self):
+			"""
+				makes room in read_buffer for the rest of the frame being received.
+				the buffer grows as the frame arrives, at most doubling each time it
+				is full, not to the length the client declares
+			"""
+			buffered = self.read_end - self.read_start
+			need = 8
+			if buffered >= 8:
+				need = 4 + struct.unpack_from('!I', self.read_buffer, self.read_start)[0]
+			if self.read_start + need <= len(self.read_buffer) and self.read_end < len(self.read_buffer):
+				return
+			buf = self.read_buffer
+			if buffered == len(buf):
+				self.read_buffer = bytearray(min(need, 2 * len(buf)))
+			self.read_buffer[:buffered] = buf[self.read_start:self.read_end]
+			self.read_start = 0
+			self.read_end = buffered
 
 		def handle_read(self):
-			if self.read_msg_id is None:
-				to_recv = 8 - len(self.read_buffer)
-				self.read_buffer += self.recv(to_recv)
-				if len(self.read_buffer) == 8:
-					self.read_msg_len, self.read_msg_id = struct.unpack('!II', self.read_buffer)
-					self.read_buffer = b''
-					if self.read_msg_len < 4:
-						self.close()
-						return
-					self.read_msg_len -= 4
-			if self.read_msg_id is not None:
-				if len(self.read_buffer) < self.read_msg_len:
-					to_recv = self.read_msg_len - len(self.read_buffer)
-					self.read_buffer += self.recv(to_recv)
-				if len(self.read_buffer) == self.read_msg_len:
-					self.handle_request()
-					self.read_buffer = b''
-					self.read_msg_id = None
-					self.read_msg_len = 0
+			self.reserve()
+			view = memoryview(self.read_buffer)
+			self.read_end += self.recv_into(view[self.read_end:])
+
+			# every complete frame received so far, requests are parsed straight from the buffer
+			while self.connected and self.read_end - self.read_start >= 8:
+				msg_len, msgid = struct.unpack_from('!II', self.read_buffer, self.read_start)
+				if msg_len < 4 or msg_len > self._server._max_frame:
+					self.handle_close()
+					return
+				end = self.read_start + 4 + msg_len
+				if end > self.read_end:
+					break
+				self.handle_request(msgid, view[self.read_start + 8:end])
+				self.read_start = end
+
+			if self.read_start == self.read_end:
+				self.read_start = self.read_end = 0
+				if len(self.read_buffer) > _READ_CHUNK:
+					# large buffers are not kept once their frame is handled
+					self.read_buffer = bytearray(_READ_CHUNK)
+
+			if self.connected and len(self.out_queue):
+				self.handle_write()
 
 	def __init__(self, **kvargs):
+		if asyncore is None:
+			raise IncorrectUse("asyncore is not available, use aiopbservice.AsyncPBServer")
 		common.__init__(self, kvargs)
+		self._init_offload(kvargs)
+		self._max_output = 4 * 1024 * 1024
+		self._max_frame = 64 * 1024 * 1024  # larger requests close the connection
+
+		if 'max_output' in kvargs:
+			self._max_output = kvargs['max_output']
+		if 'max_frame' in kvargs:
+			self._max_frame = kvargs['max_frame']
+
+		self._handlers = {}
+		self._memos = {}  # handler name -> cache of a memoized handler
+		self._init_metrics_request(kvargs)
 		self.client_conns = []
 		self.listening_conn = self.ListeningConnection(self)
 
+	def _handler(self, msgid):
+		""" request class and bound handler method by request msgid """
+		handler = self._handlers.get(msgid)
+		if handler is None:
+			name = self._codec.handler_names[msgid]
+			f = getattr(self, name)
+			if getattr(f, '_pb_memoize', None) is not None:
+				f = self._memoized(name, f)
+			handler = self._handlers[msgid] = (self._codec.requests[msgid], f)
+		return handler
+
+	def _encode_response(self, o):
+		# handlers may return a frame encoded already
+		if isinstance(o, bytes):
+			return o
+		return self._codec.encode(o)
+
+	def _init_metrics_request(self, kvargs):
+		if kvargs.get('metrics_request'):
+			self._handlers[METRICS_MSGID] = (_RawRequest, self._metrics_request)
+
+	def _metrics_request(self, req):
+		body = json.dumps({'metrics': self.metrics_snapshot(), 'offload': self.offload_stats()}).encode('utf-8')
+		return MessageCodec._header.pack(4 + len(body), METRICS_MSGID) + body
+
+	def _method_name(self, msgid):
+		if msgid == METRICS_MSGID:
+			return 'metrics_request'
+		return self._codec.handler_names[msgid]
+
+	def _instrumented_decode(self, msgid, body):
+		# the request part of handle_request with hooks and metrics
+		name = self._method_name(msgid)
+		started = self._before('decode', name)
+		try:
+			req_class, handler = self._handler(msgid)
+			req = req_class()
+			req.ParseFromString(body)
+		except Exception as e:
+			self._failed('decode', name, started, e)
+			raise
+		self._record(name, (('decode', self._after('decode', name, started, len(body))),), bytes_in=8 + len(body))
+		return req_class, handler, req, name
+
+	def _instrumented_response(self, name, o, started, phases=()):
+		""" encodes the response of a handler dispatched at started, records the call """
+		handled = self._after('dispatch', name, started, None)
+		encode_started = self._before('encode', name)
+		frame = self._encode_response(o)
+		encoded = self._after('encode', name, encode_started, len(frame))
+		error_code = 0 if isinstance(o, bytes) else self._error_code(o)
+		self._record(name, phases + (('handle', handled), ('encode', encoded)),
+			calls=1, bytes_out=len(frame), error_code=error_code)
+		return frame
+
+	def _instrumented_failure(self, name, started, e):
+		self._failed('dispatch', name, started, e)
+		self._record(name, failures=1)
+
+	def _instrumented_call(self, name, handler, req):
+		started = self._before('dispatch', name)
+		try:
+			o = handler(req)
+		except Exception as e:
+			self._instrumented_failure(name, started, e)
+			raise
+		return self._instrumented_response(name, o, started)
+
+	def _instrumented_offload(self, name, handler):
+		""" handler for the thread pool recording its time in the queue too """
+		submitted = time.perf_counter()
+		def call(req):
+			started = self._before('dispatch', name)
+			try:
+				o = handler(req)
+			except Exception as e:
+				self._instrumented_failure(name, started, e)
+				raise
+			return self._instrumented_response(name, o, started, (('queue', started - submitted),))
+		return call
+
+	@staticmethod
+	def blocking(f):
+		"""
+			marks a handler to run on a pool of threads=N threads instead of
+			the event loop, offload_all=True sends every handler there.
+			responses still go out in request order.
+		"""
+		f._pb_blocking = True
+		return f
+
+	@staticmethod
+	def memoize(ttl=60, max_entries=10000, max_bytes=None):
+		"""
+			caches the encoded responses of a handler that is a pure function
+			of its request, by serialized request, for ttl seconds. past
+			max_entries or max_bytes the least recently used go first. hits
+			skip the handler and the encoding, error responses are not cached.
+
+			@PBServer.memoize(ttl=300, max_bytes=64 * 1024 * 1024)
+			def request_city_list(self, request):
+		"""
+		def deco(f):
+			f._pb_memoize = (ttl, max_entries, max_bytes)
+			return f
+		return deco
+
+	def _memoized(self, name, handler):
+		ttl, max_entries, max_bytes = handler._pb_memoize
+		memo = self._memos[name] = _LRUCache(max_entries, max_bytes)
+		def compute(req, key=None):
+			return self._memo_result(memo, key or req.SerializeToString(), ttl, handler(req))
+		def memoized(req):
+			key = req.SerializeToString()
+			frame = memo.get(key)
+			if frame is None:
+				return compute(req, key)
+			return frame
+		memoized._pb_blocking = getattr(handler, '_pb_blocking', False)
+		memoized._pb_memo = (memo, compute)
+		return memoized
+
+	def _memo_result(self, memo, key, ttl, o):
+		# errors are not cached, they go out as messages for the caller to encode and count
+		if not isinstance(o, bytes) and self._is_service_error(o):
+			return o
+		frame = self._encode_response(o)
+		memo.put(key, frame, len(key) + len(frame), ttl)
+		return frame
+
+	def _cached_offload(self, handler, req):
+		"""
+			(the cached response, None) for a hit of a memoized handler,
+			otherwise (None, the function to run in the thread pool)
+		"""
+		memo = getattr(handler, '_pb_memo', None)
+		if memo is None:
+			return None, handler
+		frame = memo[0].get(req.SerializeToString())
+		if frame is not None:
+			return frame, None
+		return None, memo[1]
+
+	def memo_stats(self):
+		""" stats of the caches of memoized handlers by handler name, see memoize """
+		return dict((name, memo.stats()) for name, memo in self._memos.items())
+
+	def invalidate_memo(self, name=None, req=None):
+		"""
+			drops the cached response to the pb2 request req, or all the
+			responses of the handler name ('request_city_list'), or everything
+		"""
+		if req is not None:
+			memo = self._memos.get(req.DESCRIPTOR.name)
+			if memo is not None:
+				key = req.SerializeToString()
+				memo.invalidate(lambda k: k == key)
+		else:
+			for memo_name, memo in list(self._memos.items()):
+				if name is None or name == memo_name:
+					memo.invalidate()
+
+	def _init_offload(self, kvargs):
+		self._threads = 0
+		self._offload_all = False
+		self._max_pipeline = 64
+		self._executor = None
+		self._trigger = None
+		self._completed = collections.deque()
+		self._offload_lock = threading.Lock()
+		self._offload_stats = {'queued': 0, 'running': 0, 'completed': 0, 'wait_time': 0.0, 'max_wait_time': 0.0}
+
+		if 'threads' in kvargs:
+			self._threads = kvargs['threads']
+		if 'offload_all' in kvargs:
+			self._offload_all = kvargs['offload_all']
+		if 'max_pipeline' in kvargs:
+			self._max_pipeline = kvargs['max_pipeline']
+
+	def _offloaded(self, handler):
+		return self._threads > 0 and (self._offload_all or getattr(handler, '_pb_blocking', False))
+
+	def _get_executor(self):
+		# created on first use, so that every prefork worker gets its own threads
+		if self._executor is None:
+			self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+		return self._executor
+
+	def _call_offloaded(self, handler, req, submitted):
+		started = time.time()
+		wait_time = started - submitted
+		stats = self._offload_stats
+		with self._offload_lock:
+			stats['queued'] -= 1
+			stats['running'] += 1
+			stats['wait_time'] += wait_time
+			stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+		try:
+			return self._encode_response(handler(req))
+		finally:
+			with self._offload_lock:
+				stats['running'] -= 1
+				stats['completed'] += 1
+
+	def _offload(self, handler, req):
+		with self._offload_lock:
+			self._offload_stats['queued'] += 1
+		return self._get_executor().submit(self._call_offloaded, handler, req, time.time())
+
+	def _submit(self, conn, slot, handler, req):
+		if self._trigger is None:
+			self._trigger = self.Trigger(self)
+
+		def done(future):
+			if future.exception() is None:
+				self._completed.append((conn, slot, future.result(), None))
+			else:
+				e = future.exception()
+				self._completed.append((conn, slot, None, (type(e), e, e.__traceback__)))
+			self._trigger.pull()
+
+		self._offload(handler, req).add_done_callback(done)
+
+	def offload_stats(self):
+		"""
+			queued: requests waiting for a free thread, running: requests
+			being handled, wait_time: total seconds spent in the queue by
+			the ones which got a thread
+		"""
+		with self._offload_lock:
+			stats = dict(self._offload_stats)
+		stats['threads'] = self._threads
+		started = stats['completed'] + stats['running']
+		stats['avg_wait_time'] = stats['wait_time'] / started if started else 0.0
+		return stats
+
 	def generic(self, error_code, error_text=None):
 		response = self.proto.response_generic()
 		response.error_code = error_code
@@ -252,9 +1483,75 @@ class PBServer(common):
 			error_code = -getattr(self.proto, errno_name.upper())
 			return lambda error_text: self.generic(error_code, error_text)
 
-	def serve(self):
+	def _run(self):
 		asyncore.loop()
 
+	def _listen_in_master(self, reuse_port):
+		if reuse_port:
+			# every worker binds its own socket and the kernel spreads connections between them
+			self._addr = self.listening_conn.socket.getsockname()
+			self.listening_conn.close()
+		return reuse_port
+
+	def _listen_in_worker(self, reuse_port):
+		if reuse_port:
+			self.listening_conn = self.ListeningConnection(self, reuse_port=True)
+
+	def _prefork(self, workers):
+		reuse_port = self._family == socket.AF_INET and hasattr(socket, 'SO_REUSEPORT')
+		reuse_port = self._listen_in_master(reuse_port)
+
+		children = {}  # pid -> start time
+		stopping = []
+
+		def spawn():
+			pid = os.fork()
+			if pid == 0:
+				signal.signal(signal.SIGTERM, signal.SIG_DFL)
+				signal.signal(signal.SIGINT, signal.SIG_DFL)
+				status = 0
+				try:
+					self._listen_in_worker(reuse_port)
+					self._run()
+				except BaseException:
+					traceback.print_exc()
+					status = 1
+				finally:
+					sys.stderr.flush()
+					os._exit(status)
+			children[pid] = time.time()
+
+		def stop(signum, frame):
+			stopping.append(signum)
+			for pid in children:
+				os.kill(pid, signal.SIGTERM)
+
+		signal.signal(signal.SIGTERM, stop)
+		signal.signal(signal.SIGINT, stop)
+
+		for i in range(workers):
+			spawn()
+
+		while len(children):
+			pid, status = os.wait()
+			started = children.pop(pid, None)
+			if started is None or len(stopping):
+				continue
+			if time.time() - started < 1:
+				time.sleep(1)  # do not spin on a worker that dies right at startup
+			if not len(stopping):
+				spawn()
+
+	def serve(self, workers=1):
+		"""
+			with workers > 1 forks that many processes serving the same
+			address and restarts the ones which die, until SIGTERM or SIGINT
+		"""
+		if workers > 1:
+			self._prefork(workers)
+		else:
+			self._run()
+
 if __name__ == '__main__':
 
 	""" client example """
@@ -11,44 +11,36 @@ __version__='0.0.5'
 __author__='Paul Dovbush <dpp@dpp.su>'
 
 
-import json	# py2.6+ TODO: add support for other JSON serialization modules
+import io
+import json
+import weakref
+import threading
+import collections
+import collections.abc
+from json.encoder import encode_basestring_ascii as _encode_str
+from google.protobuf.message import Message
 from google.protobuf.descriptor import FieldDescriptor as FD
 
 
 class ParseError(Exception): pass
 
 
-def json2pb(pb, js):
-	''' convert JSON string to google.protobuf.descriptor instance '''
+try:
+	unicode
+except NameError:	# py3
+	unicode = str
+	long = int
 
-	for field in pb.DESCRIPTOR.fields:
-		if field.name not in js:
-			continue
-		if field.type == FD.TYPE_MESSAGE:
-			pass
-		elif field.type == FD.TYPE_ENUM:
-			pass
-		elif field.type in _js2ftype:
-			ftype = _js2ftype[field.type]
-		else:
-			raise ParseError("Field %s.%s of type '%d' is not supported" % (pb.__class__.__name__, field.name, field.type, ))
-		value = js[field.name]
-		if field.label == FD.LABEL_REPEATED:
-			pb_value = getattr(pb, field.name, None)
-			for v in value:
-				if field.type == FD.TYPE_MESSAGE:
-					json2pb(pb_value.add(), v)
-				elif field.type == FD.TYPE_ENUM:
-					pb_value.append(enum_value_as_int(field, value))
-				else:
-					pb_value.append(ftype(v))
-		else:
-			if field.type == FD.TYPE_MESSAGE:
-				json2pb(getattr(pb, field.name, None), value)
-			elif field.type == FD.TYPE_ENUM:
-				setattr(pb, field.name, enum_value_as_int(field, value))
-			else:
-				setattr(pb, field.name, ftype(value))
+
+def json2pb(pb, js, mask=None):
+	''' convert JSON string to google.protobuf.descriptor instance, only the fields selected by mask if given '''
+	if mask is None:
+		convert = _json2pb_converters.get(pb.DESCRIPTOR)
+		if convert is None:
+			convert = _json2pb_converter(pb.DESCRIPTOR)
+	else:
+		convert = _masked_converter(_masked_json2pb_converters, _masked_json2pb_converter, pb.DESCRIPTOR, mask)
+	convert(pb, js)
 	return pb
 
 
@@ -76,32 +68,644 @@ def enum_value_as_str(field, value):
 		return value
 
 
-def pb2json(pb):
-	''' convert google.protobuf.descriptor instance to JSON string '''
-	js = {}
-	# fields = pb.DESCRIPTOR.fields #all fields
-	fields = pb.ListFields()	#only filled (including extensions)
+def pb2json(pb, mask=None):
+	''' convert google.protobuf.descriptor instance to JSON string, only the fields selected by mask if given '''
+	if mask is None:
+		convert = _pb2json_converters.get(pb.DESCRIPTOR)
+		if convert is None:
+			convert = _pb2json_converter(pb.DESCRIPTOR)
+	else:
+		convert = _masked_converter(_masked_pb2json_converters, _masked_pb2json_converter, pb.DESCRIPTOR, mask)
+	return convert(pb)
+
+
+def pb2json_bytes(pb, backend=None):
+	''' convert google.protobuf.descriptor instance (or a JsonView of one) to UTF-8 encoded JSON bytes '''
+	dumps = _backends[backend or _default_backend][0]
+	if isinstance(pb, JsonView):
+		return dumps(pb.copy())
+	return dumps(pb2json(pb))
+
+
+def json_bytes2pb(pb, data, backend=None):
+	''' convert JSON bytes (or string) to google.protobuf.descriptor instance '''
+	loads = _backends[backend or _default_backend][1]
+	return json2pb(pb, loads(data))
+
+
+def json_backends():
+	''' names of the available JSON backends, fastest first '''
+	return [name for name in _backend_order if name in _backends]
+
+
+def set_json_backend(name):
+	''' backend used by pb2json_bytes/json_bytes2pb when none is given '''
+	global _default_backend
+	if name not in _backends:
+		raise ValueError("JSON backend %r is not available, have %s" % (name, json_backends()))
+	_default_backend = name
+
+
+def json_default(o):
+	''' default= hook of json.dumps and orjson.dumps serializing JsonView and JsonListView '''
+	if isinstance(o, (JsonView, JsonListView)):
+		return o.copy()
+	raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
+
+
+# JSON backends are (dumps, loads) pairs, dumps returns compact UTF-8 bytes
+# and serializes JSON views found in the value.
+# Note that orjson writes NaN and Infinity as null and refuses integers
+# beyond 64 bits, the stdlib json backend accepts both.
+
+_backend_order = ('orjson', 'ujson', 'json')
+_backends = {
+	'json': (
+		lambda o: json.dumps(o, ensure_ascii=False, separators=(',', ':'), default=json_default).encode('utf-8'),
+		json.loads,
+	),
+}
+
+try:
+	import orjson
+	_backends['orjson'] = (lambda o: orjson.dumps(o, default=json_default), orjson.loads)
+except ImportError:
+	pass
+
+try:
+	import ujson
+	ujson.dumps([], default=json_default)	# ujson before 5.2 has no default=
+	_backends['ujson'] = (
+		lambda o: ujson.dumps(o, ensure_ascii=False, default=json_default).encode('utf-8'),
+		ujson.loads,
+	)
+except (ImportError, TypeError):
+	pass
+
+_default_backend = json_backends()[0]
+
+
+# Converters are compiled once per message Descriptor (not per class, so that
+# modules built by dynproto work too) into closures with all decisions about
+# field types and labels already taken.
+#
+# A converter is published in the cache before its fields are compiled, which
+# makes recursive message types work. A converter which is still being
+# compiled sees some of its fields missing and converts them the slow way.
+#
+# The caches are weak-keyed, converters keep no reference to descriptors
+# (fields are known by number) so that they go away with their module.
+
+_pb2json_converters = weakref.WeakKeyDictionary()
+_json2pb_converters = weakref.WeakKeyDictionary()
+
+# protobuf already hands out values of these types, no need to convert them again
+_native = (int, float, bool, str)
+
+
+def _unsupported(descriptor, field):
+	error = "Field %s.%s of type '%d' is not supported" % (descriptor.name, field.name, field.type)
+	def convert(*a):
+		raise ParseError(error)
+	return convert
+
+
+def _unknown_enum(field, known):
+	''' enum_value_as_str/enum_value_as_int of a value not in known, without keeping the field '''
+	full_name = field.full_name
+	def convert(value):
+		if type(value) in known:
+			raise ParseError("Field %s unknown enum value '%s'" % (full_name, value))
+		return value
+	return convert
+
+
+def _item_pb2json(descriptor, field):
+	''' converter of one value of a field, None when values need no conversion '''
+	if field.type == FD.TYPE_MESSAGE:
+		return _pb2json_converter(field.message_type)
+	elif field.type == FD.TYPE_ENUM:
+		names = dict((v.number, v.name) for v in field.enum_type.values)
+		unknown = _unknown_enum(field, (int, long))
+		def convert(value):
+			if value in names:
+				return names[value]
+			return unknown(value)
+		return convert
+	elif field.type in _ftype2js:
+		convert = _ftype2js[field.type]
+		if convert in _native:
+			return None
+		return convert
+	else:
+		return _unsupported(descriptor, field)
 
-	def field_get_value(field, value):
-		if field.type == FD.TYPE_MESSAGE:
-			return pb2json(value)
-		elif field.type == FD.TYPE_ENUM:
-			return enum_value_as_str(field, value)
-		elif field.type in _ftype2js:
-			return _ftype2js[field.type](value)
+
+def _field_pb2json(descriptor, field):
+	''' converter of a whole field value, None when it needs no conversion '''
+	convert = _item_pb2json(descriptor, field)
+	if field.label == FD.LABEL_REPEATED:
+		if convert is None:
+			return list
+		item_convert = convert
+		return lambda value: [item_convert(v) for v in value]
+	return convert
+
+
+def _pb2json_converter(descriptor):
+	convert = _pb2json_converters.get(descriptor)
+	if convert is not None:
+		return convert
+
+	fields = {}
+
+	def convert(pb):
+		js = {}
+		for field, value in pb.ListFields():	#only filled (including extensions)
+			if field.number in fields:
+				name, convert_value = fields[field.number]
+				js[name] = value if convert_value is None else convert_value(value)
+			else:	# extension or a field not compiled yet
+				convert_value = _field_pb2json(pb.DESCRIPTOR, field)
+				js[field.name] = value if convert_value is None else convert_value(value)
+		return js
+
+	_pb2json_converters[descriptor] = convert
+	for field in descriptor.fields:
+		fields[field.number] = (field.name, _field_pb2json(descriptor, field))
+	return convert
+
+
+def _field_json2pb(descriptor, field):
+	''' setter of one field, takes the message and the JSON value '''
+	name = field.name
+	repeated = field.label == FD.LABEL_REPEATED
+
+	if field.type == FD.TYPE_MESSAGE:
+		convert = _json2pb_converter(field.message_type)
+		if repeated:
+			def setter(pb, value):
+				container = getattr(pb, name)
+				for v in value:
+					convert(container.add(), v)
 		else:
-			raise ParseError("Field %s.%s of type '%d' is not supported" % (pb.__class__.__name__, field.name, field.type))
+			def setter(pb, value):
+				convert(getattr(pb, name), value)
+		return setter
+
+	if field.type == FD.TYPE_ENUM:
+		numbers = dict((v.name, v.number) for v in field.enum_type.values)
+		unknown = _unknown_enum(field, (str, unicode))
+		def ftype(value):
+			if value in numbers:
+				return numbers[value]
+			return unknown(value)
+	elif field.type in _js2ftype:
+		ftype = _js2ftype[field.type]
+	else:
+		return _unsupported(descriptor, field)
+
+	if repeated:
+		def setter(pb, value):
+			getattr(pb, name).extend([ftype(v) for v in value])
+	else:
+		def setter(pb, value):
+			setattr(pb, name, ftype(value))
+	return setter
+
+
+def _json2pb_converter(descriptor):
+	convert = _json2pb_converters.get(descriptor)
+	if convert is not None:
+		return convert
+
+	setters = {}
+
+	def convert(pb, js):
+		for name, value in js.items():
+			if name in setters:
+				setters[name](pb, value)
+			elif name in pb.DESCRIPTOR.fields_by_name:	# not compiled yet
+				_field_json2pb(pb.DESCRIPTOR, pb.DESCRIPTOR.fields_by_name[name])(pb, value)
+
+	_json2pb_converters[descriptor] = convert
+	for field in descriptor.fields:
+		setters[field.name] = _field_json2pb(descriptor, field)
+	return convert
+
+
+# Masks select fields by dotted paths, 'user.profile.name'. A path ending
+# in a message field selects all of it, '*' selects all fields of a message
+# and after a repeated field stands for its elements, 'rows.*.id' is the
+# same as 'rows.id'. A mask is given as a list of paths, a comma separated
+# string or a FieldMask, and is compiled once per message Descriptor into
+# converters which visit only the selected fields. Masks come from callers
+# and are unbounded, only the last _MASKED_CACHE_SIZE of them are kept.
+
+_MASKED_CACHE_SIZE = 1024
+_masked_pb2json_converters = collections.OrderedDict()	# (descriptor, paths) -> converter
+_masked_json2pb_converters = collections.OrderedDict()
+_masked_lock = threading.Lock()
+
+
+def _mask_paths(mask):
+	''' the paths of a mask stripped, deduplicated and sorted, so that equal masks share a converter '''
+	paths = getattr(mask, 'paths', mask)	# FieldMask
+	if isinstance(paths, (str, unicode)):
+		paths = paths.split(',')
+	return tuple(sorted(set(path.strip() for path in paths) - set([''])))
+
+
+def _masked_converter(cache, build, descriptor, mask):
+	key = (descriptor, _mask_paths(mask))
+	with _masked_lock:
+		convert = cache.get(key)
+		if convert is not None:
+			cache.move_to_end(key)
+			return convert
+	convert = build(descriptor, _mask_tree(key[1]))
+	with _masked_lock:
+		cache[key] = convert
+		while len(cache) > _MASKED_CACHE_SIZE:
+			cache.popitem(last=False)
+	return convert
+
+
+def _mask_merge(a, b):
+	if a is None or b is None:	# all of it
+		return None
+	merged = dict(a)
+	for name, sub in b.items():
+		merged[name] = _mask_merge(merged[name], sub) if name in merged else sub
+	return merged
+
+
+def _mask_tree(paths):
+	''' {name: subtree or None for the whole field} '''
+	tree = {}
+	for path in paths:
+		path = path.strip()
+		if not path:
+			continue
+		sub = None
+		for name in reversed(path.split('.')):
+			sub = {name: sub}
+		tree = _mask_merge(tree, sub)
+	return tree
+
+
+def _mask_fields(descriptor, tree):
+	''' (field, subtree) pairs selected by a mask tree, in field number order '''
+	if '*' in tree:
+		if tree['*'] is not None:
+			raise ParseError("Mask of %s: '*' must be last or follow a repeated field" % descriptor.full_name)
+		return [(field, None) for field in sorted(descriptor.fields, key=lambda f: f.number)]
+	selected = []
+	for name, sub in tree.items():
+		field = descriptor.fields_by_name.get(name)
+		if field is None:
+			raise ParseError("Mask of %s: no field %s" % (descriptor.full_name, name))
+		if sub is not None:
+			if field.type != FD.TYPE_MESSAGE:
+				raise ParseError("Mask of %s: field %s is not a message" % (descriptor.full_name, name))
+			if field.label == FD.LABEL_REPEATED and '*' in sub:	# elements
+				rest = dict((n, s) for n, s in sub.items() if n != '*')
+				sub = _mask_merge(rest, sub['*']) if len(rest) else sub['*']
+		selected.append((field, sub))
+	return sorted(selected, key=lambda fs: fs[0].number)
+
+
+def _filled(field):
+	''' tells whether ListFields() would return the field, takes the message and the value '''
+	name = field.name
+	if field.label == FD.LABEL_REPEATED:
+		return lambda pb, value: len(value) > 0
+	if field.type == FD.TYPE_MESSAGE or field.containing_oneof is not None or not _proto3(field):
+		return lambda pb, value: pb.HasField(name)
+	default = field.default_value
+	return lambda pb, value: value != default
+
 
-	for field,value in fields:
-		if field.label == FD.LABEL_REPEATED:
-			js_value = []
+def _proto3(field):
+	# descriptors made by dynproto know no file, they are proto2
+	file = getattr(field.containing_type, 'file', None)
+	return file is not None and file.syntax == 'proto3'
+
+
+def _masked_field_pb2json(descriptor, field, sub):
+	if sub is None:
+		return _field_pb2json(descriptor, field)
+	convert = _masked_pb2json_converter(field.message_type, sub)
+	if field.label == FD.LABEL_REPEATED:
+		return lambda value: [convert(v) for v in value]
+	return convert
+
+
+def _masked_pb2json_converter(descriptor, tree):
+	fields = [(field.name, _filled(field), _masked_field_pb2json(descriptor, field, sub))
+		for field, sub in _mask_fields(descriptor, tree)]
+
+	def convert(pb):
+		js = {}
+		for name, filled, convert_value in fields:
+			value = getattr(pb, name)
+			if filled(pb, value):
+				js[name] = value if convert_value is None else convert_value(value)
+		return js
+	return convert
+
+
+def _masked_field_json2pb(descriptor, field, sub):
+	if sub is None:
+		return _field_json2pb(descriptor, field)
+	name = field.name
+	convert = _masked_json2pb_converter(field.message_type, sub)
+	if field.label == FD.LABEL_REPEATED:
+		def setter(pb, value):
+			container = getattr(pb, name)
 			for v in value:
-				js_value.append(field_get_value(field, v))
+				convert(container.add(), v)
+	else:
+		def setter(pb, value):
+			convert(getattr(pb, name), value)
+	return setter
+
+
+def _masked_json2pb_converter(descriptor, tree):
+	setters = [(field.name, _masked_field_json2pb(descriptor, field, sub))
+		for field, sub in _mask_fields(descriptor, tree)]
+
+	def convert(pb, js):
+		for name, setter in setters:
+			if name in js:
+				setter(pb, js[name])
+	return convert
+
+
+def pb2json_view(pb):
+	'''
+		read-only dict-like view of pb2json(pb) converting fields on first access, pb must not change meanwhile.
+		a view is a Mapping, not a dict: serialize it with pb2json_bytes, or pass default=json_default
+		to json.dumps and orjson.dumps
+	'''
+	return JsonView(pb)
+
+
+class JsonView(collections.abc.Mapping):
+
+	'''
+		Mapping of the filled fields of a message, values are converted the
+		way pb2json does when first read and kept. Nested messages become
+		JsonView and repeated ones JsonListView. Compares equal to the dict
+		pb2json returns, copy() gives that dict.
+	'''
+
+	__slots__ = ('_pb', '_filled', '_values')
+
+	def __init__(self, pb):
+		self._pb = pb
+		self._filled = None	# {name: (field, value)}
+		self._values = {}
+
+	def _fields(self):
+		if self._filled is None:
+			self._filled = dict((field.name, (field, value)) for field, value in self._pb.ListFields())
+		return self._filled
+
+	def __getitem__(self, name):
+		values = self._values
+		if name in values:
+			return values[name]
+		field, value = self._fields()[name]
+		convert = _view_converter(self._pb.DESCRIPTOR, field)
+		if convert is not None:
+			value = convert(value)
+		values[name] = value
+		return value
+
+	def __contains__(self, name):
+		return name in self._fields()
+
+	def __iter__(self):
+		return iter(self._fields())
+
+	def __len__(self):
+		return len(self._fields())
+
+	def __repr__(self):
+		return 'JsonView(%r)' % dict(self.items())
+
+	def copy(self):
+		return pb2json(self._pb)
+
+
+class JsonListView(collections.abc.Sequence):
+
+	''' Sequence over a repeated message field, items become JsonView when first read '''
+
+	__slots__ = ('_items', '_views')
+
+	def __init__(self, items):
+		self._items = items
+		self._views = {}
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self._items)))]
+		item = self._items[index]
+		if index < 0:
+			index += len(self._items)
+		views = self._views
+		if index not in views:
+			views[index] = JsonView(item)
+		return views[index]
+
+	def __len__(self):
+		return len(self._items)
+
+	def __eq__(self, other):
+		if isinstance(other, (list, JsonListView)):
+			return list(self) == list(other)
+		return NotImplemented
+
+	def __ne__(self, other):
+		equal = self.__eq__(other)
+		return equal if equal is NotImplemented else not equal
+
+	def __repr__(self):
+		return 'JsonListView(%r)' % list(self)
+
+	def copy(self):
+		return [view.copy() for view in self]
+
+
+_view_converters = weakref.WeakKeyDictionary()
+
+
+def _view_field(descriptor, field):
+	if field.type == FD.TYPE_MESSAGE:
+		return JsonListView if field.label == FD.LABEL_REPEATED else JsonView
+	return _field_pb2json(descriptor, field)
+
+
+def _view_converter(descriptor, field):
+	''' converter of a field value for JsonView, None when it needs no conversion '''
+	fields = _view_converters.get(descriptor)
+	if fields is None:
+		fields = _view_converters[descriptor] = dict((f.number, _view_field(descriptor, f)) for f in descriptor.fields)
+	if field.number in fields:
+		return fields[field.number]
+	return _view_field(descriptor, field)	# extension
+
+
+def dump(pb, fp):
+	''' write JSON of a message to a file-like object as it goes, repeated fields item by item '''
+	out = _Output(fp)
+	_streamer(pb.DESCRIPTOR)(pb, out)
+	out.flush()
+
+
+def dump_ndjson(messages, fp):
+	''' write an iterable of messages (or one message) as newline delimited JSON, returns the count '''
+	if isinstance(messages, Message):
+		messages = [messages]
+	out = _Output(fp)
+	n = 0
+	for pb in messages:
+		stream = _streamers.get(pb.DESCRIPTOR)
+		if stream is None:
+			stream = _streamer(pb.DESCRIPTOR)
+		stream(pb, out)
+		out.write('\n')
+		n += 1
+	out.flush()
+	return n
+
+
+class _Output(object):
+
+	''' collects small writes into chunks of about limit characters '''
+
+	def __init__(self, fp, limit=65536):
+		self.fp = fp
+		self.binary = isinstance(fp, (io.RawIOBase, io.BufferedIOBase))
+		self.limit = limit
+		self.parts = []
+		self.size = 0
+
+	def write(self, s):
+		self.parts.append(s)
+		self.size += len(s)
+		if self.size >= self.limit:
+			self.flush()
+
+	def flush(self):
+		chunk = ''.join(self.parts)
+		self.parts = []
+		self.size = 0
+		self.fp.write(chunk.encode('utf-8') if self.binary else chunk)
+
+
+# Streamers write a message to an _Output, nested messages and repeated
+# fields are written piece by piece so that memory stays bounded by the
+# largest scalar value. They are compiled and cached the same way as
+# converters above.
+
+_streamers = weakref.WeakKeyDictionary()
+_encode = json.JSONEncoder().encode
+_STREAM_CHUNK = 1024	# items of a repeated scalar field encoded at once
+_INF = float('inf')
+
+
+def _encode_float(value):
+	if value != value or value in (_INF, -_INF):
+		return _encode(value)	# NaN and Infinity spelled the way json does
+	return float.__repr__(value)
+
+
+def _encode_bool(value):
+	return 'true' if value else 'false'
+
+
+def _value_encoder(descriptor, field):
+	''' turns one value of a scalar or enum field straight into JSON text '''
+	if field.type == FD.TYPE_ENUM:
+		names = dict((v.number, _encode_str(v.name)) for v in field.enum_type.values)
+		unknown = _unknown_enum(field, (int, long))
+		def encode(value):
+			if value in names:
+				return names[value]
+			return _encode(unknown(value))
+		return encode
+	convert = _ftype2js.get(field.type)
+	if convert is None:
+		return _unsupported(descriptor, field)
+	elif convert is int:
+		return int.__repr__
+	elif convert is float:
+		return _encode_float
+	elif convert is bool:
+		return _encode_bool
+	elif convert is str:
+		return _encode_str
+	return lambda value: _encode(convert(value))
+
+
+def _field_streamer(descriptor, field):
+	key = _encode(field.name) + ':'
+	repeated = field.label == FD.LABEL_REPEATED
+
+	if field.type == FD.TYPE_MESSAGE:
+		stream = _streamer(field.message_type)
+		if repeated:
+			def write(value, out):
+				out.write(key + '[')
+				for i, v in enumerate(value):
+					if i:
+						out.write(',')
+					stream(v, out)
+				out.write(']')
 		else:
-			js_value = field_get_value(field, value)
+			def write(value, out):
+				out.write(key)
+				stream(value, out)
+		return write
+
+	encode = _value_encoder(descriptor, field)
+	if repeated:
+		def write(value, out):
+			out.write(key + '[')
+			for start in range(0, len(value), _STREAM_CHUNK):
+				out.write((',' if start else '') + ','.join(map(encode, value[start:start + _STREAM_CHUNK])))
+			out.write(']')
+	else:
+		def write(value, out):
+			out.write(key + encode(value))
+	return write
+
+
+def _streamer(descriptor):
+	stream = _streamers.get(descriptor)
+	if stream is not None:
+		return stream
+
+	fields = {}
+
+	def stream(pb, out):
+		sep = '{'
+		for field, value in pb.ListFields():
+			out.write(sep)
+			sep = ','
+			if field.number in fields:
+				fields[field.number](value, out)
+			else:	# extension or a field not compiled yet
+				_field_streamer(pb.DESCRIPTOR, field)(value, out)
+		out.write('{}' if sep == '{' else '}')
 
-		js[field.name] = js_value
-	return js
+	_streamers[descriptor] = stream
+	for field in descriptor.fields:
+		fields[field.number] = _field_streamer(descriptor, field)
+	return stream
 
 
 _ftype2js = {
@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import socket
+import struct
+import time
+import select
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from google.protobuf import descriptor_pb2
+from pb_tools.dynproto import DynFDP
+from pb_tools.pbservice import PBService, PBServer, MessageCodec, ResponseCache, IOFailed
+
+F = descriptor_pb2.FieldDescriptorProto
+
+
+def echo_module():
+	""" echo.proto: one request, its response and response_generic """
+	fdp = descriptor_pb2.FileDescriptorProto(name='echo.proto', package='echo')
+	for name, values in (('request_msgid', ['REQUEST_ECHO']), ('response_msgid', ['RESPONSE_GENERIC', 'RESPONSE_ECHO'])):
+		enum = fdp.enum_type.add(name=name)
+		for number, value_name in enumerate(values, 1):
+			enum.value.add(name=value_name, number=number)
+	for name, fields in (('request_echo', [('payload', F.TYPE_STRING), ('n', F.TYPE_INT32)]),
+			('response_echo', [('payload', F.TYPE_STRING), ('n', F.TYPE_INT32)]),
+			('response_generic', [('error_code', F.TYPE_INT32), ('error_text', F.TYPE_STRING)])):
+		msg = fdp.message_type.add(name=name)
+		for number, (field_name, field_type) in enumerate(fields, 1):
+			msg.field.add(name=field_name, number=number, type=field_type, label=F.LABEL_OPTIONAL)
+	return DynFDP(None, fdp).module
+
+
+class EchoServer(PBServer):
+
+	def request_echo(self, request):
+		return self.proto.response_echo(payload=request.payload, n=request.n)
+
+
+class ClientConnectionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = EchoServer(host='127.0.0.1', port=0, module=echo_module(), max_frame=1024 * 1024)
+		self.client, sock = socket.socketpair()
+		sock.setblocking(False)
+		self.conn = self.server.ClientConnection(self.server, sock, None)
+		self.server.client_conns.append(self.conn)
+
+	def tearDown(self):
+		self.client.close()
+		if self.conn.connected:
+			self.conn.handle_close()
+		self.server.listening_conn.close()
+
+	def test_declared_length_does_not_size_the_buffer(self):
+		# a header declaring a frame just under max_frame, then a few bytes of it
+		self.client.sendall(struct.pack('!II', 1024 * 1024, 1) + b'x')
+		self.conn.handle_read()
+		self.conn.handle_read()
+		self.assertTrue(self.conn.connected)
+		self.assertLessEqual(len(self.conn.read_buffer), 2 * 65536)
+
+	def test_frame_over_max_frame_closes(self):
+		self.client.sendall(struct.pack('!II', 1500 * 1024 * 1024, 1) + b'x')
+		self.conn.handle_read()
+		self.assertFalse(self.conn.connected)
+		self.assertEqual(self.server.client_conns, [])
+
+	def test_large_frame_is_received(self):
+		# the buffer grows while the frame arrives and is dropped after it
+		proto = self.server.proto
+		frame = self.server._codec.encode(proto.request_echo(payload='x' * 300000, n=7))
+		sender = threading.Thread(target=self.client.sendall, args=(frame,))
+		sender.start()
+		while not select.select([self.client], [], [], 0)[0]:
+			self.conn.handle_read()
+		sender.join()
+		self.assertEqual(len(self.conn.read_buffer), 65536)
+		received = []
+
+		def receive():
+			msg_len, msgid = struct.unpack('!II', self.client.recv(8, socket.MSG_WAITALL))
+			received.append(self.client.recv(msg_len - 4, socket.MSG_WAITALL))
+
+		receiver = threading.Thread(target=receive)
+		receiver.start()
+		while len(self.conn.out_queue):
+			self.conn.handle_write()
+		receiver.join()
+		response = proto.response_echo.FromString(received[0])
+		self.assertEqual((len(response.payload), response.n), (300000, 7))
+
+
+
+class SlowEchoServer(object):
+
+	""" answers echo requests from a thread, those with n >= slow_from after delay seconds """
+
+	def __init__(self, proto, slow_from, delay):
+		self.proto = proto
+		self.codec = MessageCodec.for_module(proto)
+		self.slow_from = slow_from
+		self.delay = delay
+		self.connections = 0
+		self.listener = socket.socket()
+		self.listener.bind(('127.0.0.1', 0))
+		self.listener.listen(16)
+		self.port = self.listener.getsockname()[1]
+		threading.Thread(target=self.serve, daemon=True).start()
+
+	def serve(self):
+		while True:
+			try:
+				sock, address = self.listener.accept()
+			except OSError:
+				return
+			self.connections += 1
+			threading.Thread(target=self.answer, args=(sock,), daemon=True).start()
+
+	def answer(self, sock):
+		try:
+			while True:
+				header = sock.recv(8, socket.MSG_WAITALL)
+				if len(header) < 8:
+					break
+				msg_len, msgid = struct.unpack('!II', header)
+				req = self.proto.request_echo.FromString(sock.recv(msg_len - 4, socket.MSG_WAITALL))
+				if req.n >= self.slow_from:
+					time.sleep(self.delay)
+				sock.sendall(self.codec.encode(self.proto.response_echo(n=req.n)))
+		except OSError:
+			pass
+		sock.close()
+
+	def close(self):
+		self.listener.close()
+
+
+class PBServiceTimeoutTest(unittest.TestCase):
+
+	def setUp(self):
+		self.proto = echo_module()
+		self.server = SlowEchoServer(self.proto, slow_from=5, delay=0.3)
+		self.svc = PBService(host='127.0.0.1', port=self.server.port, module=self.proto, io_timeout=0.1)
+
+	def tearDown(self):
+		self.svc.close()
+		self.server.close()
+
+	def test_call_many_timeout_drops_the_responses_in_flight(self):
+		with self.assertRaises(IOFailed):
+			self.svc.call_many([self.proto.request_echo(n=n) for n in range(10)])
+		self.assertEqual(self.server.connections, 1)  # the batch is not sent again
+		time.sleep(0.4)  # responses of the first batch would be waiting by now
+		self.assertEqual(self.svc.echo(n=3).n, 3)
+
+	def test_call_timeout_is_not_retried(self):
+		with self.assertRaises(IOFailed):
+			self.svc.echo(n=7)
+		self.assertEqual(self.server.connections, 1)
+		self.assertEqual(self.svc.echo(n=2).n, 2)
+
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+	def test_oversized_response_does_not_flush_the_cache(self):
+		proto = echo_module()
+		cache = ResponseCache({'echo': 60}, max_bytes=1000)
+		for n in range(10):
+			req = proto.request_echo(n=n)
+			cache.put(('request_echo', req.SerializeToString()), proto.response_echo(payload='x' * 40, n=n), 60)
+		req = proto.request_echo(n=10)
+		cache.put(('request_echo', req.SerializeToString()), proto.response_echo(payload='x' * 2000, n=10), 60)
+		stats = cache.stats()
+		self.assertEqual((stats['entries'], stats['evictions'], stats['oversized']), (10, 0, 1))
+		self.assertIsNone(cache.get(('request_echo', req.SerializeToString())))
+		self.assertEqual(cache.get(('request_echo', proto.request_echo(n=3).SerializeToString())).n, 3)
+
+
+
+class CatalogServer(PBServer):
+
+	@PBServer.memoize(ttl=60, max_bytes=1000)
+	def request_echo(self, request):
+		return self.proto.response_echo(payload='x' * request.n, n=request.n)
+
+
+class MemoizeTest(unittest.TestCase):
+
+	def test_oversized_response_does_not_flush_the_memo(self):
+		server = CatalogServer(host='127.0.0.1', port=0, module=echo_module())
+		server.listening_conn.close()
+		req_class, handler = server._handler(server._codec.msgids[server.proto.request_echo])
+		for n in range(10):
+			handler(req_class(n=40 + n))
+		frame = handler(req_class(n=2000))
+		self.assertEqual(server.proto.response_echo.FromString(frame[8:]).n, 2000)
+		stats = server.memo_stats()['request_echo']
+		self.assertEqual((stats['entries'], stats['evictions'], stats['oversized']), (10, 0, 1))
+		handler(req_class(n=40))
+		self.assertEqual(server.memo_stats()['request_echo']['hits'], 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,36 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pb_tools import protobuf_json
+from test_pbservice import echo_module
+
+
+class JsonViewTest(unittest.TestCase):
+
+	def setUp(self):
+		self.proto = echo_module()
+		self.pb = self.proto.response_echo(payload='x', n=3)
+
+	def test_view_serializes_like_pb2json(self):
+		view = protobuf_json.pb2json_view(self.pb)
+		self.assertEqual(view['n'], 3)
+		expected = {'data': protobuf_json.pb2json(self.pb)}
+		self.assertEqual(json.loads(json.dumps({'data': view}, default=protobuf_json.json_default)), expected)
+		for backend in protobuf_json.json_backends():
+			self.assertEqual(json.loads(protobuf_json.pb2json_bytes(view, backend)), expected['data'])
+			dumps = protobuf_json._backends[backend][0]
+			self.assertEqual(json.loads(dumps({'data': view})), expected)
+
+	def test_other_objects_are_refused(self):
+		with self.assertRaises(TypeError):
+			json.dumps(object(), default=protobuf_json.json_default)
+
+
+if __name__ == '__main__':
+	unittest.main()